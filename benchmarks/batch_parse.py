@@ -0,0 +1,98 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Benchmark: Get large batch responses in threads, projected on a few
+fields, and read these for each instance obtained; parsed in the threads,
+and in process pools of increasing size. No server is needed; the batch
+responses are synthetic.
+
+Usage: python batch_parse.py [THREADS] [PROCESSES]
+"""
+
+import sys
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from genologics.lims import Lims
+from genologics.entities import Artifact, ElementTree
+
+ARTIFACT = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" \
+xmlns:udf="http://genologics.com/ri/userdefined" limsid="%(id)s" \
+uri="http://localhost/api/v1/artifacts/%(id)s?state=1">\
+<name>Artifact %(id)s</name><type>Analyte</type><output-type>Analyte</output-type>\
+<qc-flag>PASSED</qc-flag><volume>%(n)s</volume><concentration>1.5</concentration>\
+<location><container limsid="C%(n)s" uri="http://localhost/api/v1/containers/C%(n)s"/>\
+<value>A:1</value></location>\
+<sample limsid="S%(n)s" uri="http://localhost/api/v1/samples/S%(n)s"/>\
+<udf:field type="Numeric" name="Concentration">%(n)s</udf:field>\
+<udf:field type="String" name="Flowcell">FC%(n)s</udf:field>\
+</art:artifact>"""
+
+BATCHES = 64                            # Number of batch calls.
+BATCH_SIZE = 2000                       # Number of artifacts per batch call.
+FIELDS = ['name', 'location', 'udf:Concentration']
+
+
+class CannedLims(Lims):
+    "Returns synthetic batch responses instead of calling a server."
+
+    def post(self, uri, data, params=dict(), priority=None, parse=True):
+        if parse:
+            return ElementTree.fromstring(self.content[data])
+        return self.content[data]
+
+
+def make_batches(lims):
+    "Create the instances and the canned response for each batch call."
+    batches = []
+    lims.content = dict()
+    for batch in xrange(BATCHES):
+        ids = ["A%i-%i" % (batch, n) for n in xrange(BATCH_SIZE)]
+        instances = [lims.get_artifact(id) for id in ids]
+        root = ElementTree.Element('{http://genologics.com/ri}links')
+        for instance in instances:
+            ElementTree.SubElement(root, 'link', dict(uri=instance.uri,
+                                                      rel=Artifact._URI))
+        data = lims.tostring(ElementTree.ElementTree(root))
+        lims.content[data] = '<art:details ' \
+            'xmlns:art="http://genologics.com/ri/artifact">%s</art:details>' % \
+            ''.join([ARTIFACT % dict(id=id, n=n) for n, id in enumerate(ids)])
+        batches.append(instances)
+    return batches
+
+
+def run(threads, pool):
+    """Return the time to get the batches, using the number of threads
+    and the process pool, if any, and to read the fields of each instance."""
+    lims = CannedLims('http://localhost/', 'user', 'password',
+                      parse_pool=pool)
+    batches = make_batches(lims)
+    threadpool = ThreadPool(threads)
+    def get(batch):
+        for instance in lims.get_batch(batch, fields=FIELDS):
+            instance.name
+            instance.location
+            instance.udf['Concentration']
+    start = time.time()
+    threadpool.map(get, batches)
+    elapsed = time.time() - start
+    threadpool.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    threads = len(sys.argv) > 1 and int(sys.argv[1]) or 8
+    processes = len(sys.argv) > 2 and int(sys.argv[2]) or \
+        multiprocessing.cpu_count()
+    total = BATCHES * BATCH_SIZE
+    elapsed = run(threads, None)
+    print "%i threads, no process pool: %.2f s, %i artifacts/s" % \
+        (threads, elapsed, total / elapsed)
+    count = 1
+    while count <= processes:
+        pool = multiprocessing.Pool(count)
+        elapsed = run(threads, pool)
+        pool.close()
+        print "%i threads, %i processes: %.2f s, %i artifacts/s" % \
+            (threads, count, elapsed, total / elapsed)
+        count *= 2
@@ -0,0 +1,47 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Benchmark: Load a project with its samples, artifacts, containers and
+container types from the stand-in server, one entity at a time through
+the descriptors, and with Lims.load_project_tree.
+
+Usage: python project_tree.py [SAMPLES] [LATENCY]
+"""
+
+import sys
+import time
+
+from genologics.lims import Lims
+
+from standin import Server
+
+
+def walk(lims):
+    "Access the project tree one entity at a time."
+    project = lims.get_project('P1')
+    project.name
+    for sample in lims.get_samples(projectlimsid=project.id):
+        container, well = sample.artifact.location
+        container.type.name
+
+
+def load(lims):
+    "Load the project tree in bulk, then access it."
+    tree = lims.load_project_tree('P1', depth=4)
+    for sample in tree.samples:
+        container, well = sample.artifact.location
+        container.type.name
+
+
+if __name__ == '__main__':
+    samples = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+    latency = len(sys.argv) > 2 and float(sys.argv[2]) or 0.01
+    server = Server(samples=samples, latency=latency)
+    server.start()
+    for name, function in [('One at a time', walk),
+                           ('load_project_tree', load)]:
+        lims = Lims(server.baseuri, 'user', 'password', threads=8)
+        server.requests = 0
+        start = time.time()
+        function(lims)
+        print "%s: %.2f s, %i requests, %i samples" % \
+            (name, time.time() - start, server.requests, samples)
@@ -0,0 +1,81 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Benchmark: Memory retained per artifact loaded by batch calls, in full
+and projected on a few fields. No server is needed; the batch responses
+are synthetic. Each case is measured in a fresh process, as the growth
+of its resident memory (tracemalloc is not available in Python 2).
+
+Usage: python projection_memory.py [ARTIFACTS]
+"""
+
+import gc
+import sys
+import Queue
+import resource
+import multiprocessing
+
+from genologics.entities import Artifact, ElementTree
+
+from batch_parse import CannedLims, ARTIFACT
+
+BATCH_SIZE = 500
+
+CASES = [('full XML', None),
+         ('name, qc_flag', ['name', 'qc_flag']),
+         ('name, qc_flag, udf:Concentration',
+          ['name', 'qc_flag', 'udf:Concentration'])]
+
+
+def get_memory():
+    "Return the current resident memory of this process, in bytes."
+    try:
+        with open('/proc/self/statm') as infile:
+            pages = int(infile.read().split()[1])
+        return pages * resource.getpagesize()
+    except IOError:                     # Not Linux; peak memory instead.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load(count, fields, queue):
+    "Load the artifacts, and put the memory retained per artifact."
+    lims = CannedLims('http://localhost/', 'user', 'password')
+    lims.content = dict()
+    batches = []
+    for start in xrange(0, count, BATCH_SIZE):
+        ids = ["A%i" % n for n in xrange(start, min(start + BATCH_SIZE,
+                                                    count))]
+        instances = [lims.get_artifact(id) for id in ids]
+        root = ElementTree.Element('{http://genologics.com/ri}links')
+        for instance in instances:
+            ElementTree.SubElement(root, 'link', dict(uri=instance.uri,
+                                                      rel=Artifact._URI))
+        data = lims.tostring(ElementTree.ElementTree(root))
+        lims.content[data] = '<art:details ' \
+            'xmlns:art="http://genologics.com/ri/artifact">%s</art:details>' % \
+            ''.join([ARTIFACT % dict(id=id, n=n) for n, id in enumerate(ids)])
+        batches.append(instances)
+    gc.collect()
+    before = get_memory()
+    for instances in batches:
+        lims.get_batch(instances, fields=fields)
+    gc.collect()
+    queue.put((get_memory() - before) / float(count))
+
+
+if __name__ == '__main__':
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+    for name, fields in CASES:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=load,
+                                          args=(count, fields, queue))
+        process.start()
+        while True:
+            try:
+                result = queue.get(timeout=1.0)
+                break
+            except Queue.Empty:
+                if not process.is_alive():
+                    sys.exit("%s: failed; exit code %s" %
+                             (name, process.exitcode))
+        process.join()
+        print "%s: %i bytes per artifact" % (name, result)
@@ -0,0 +1,56 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Benchmark: Run a number of short scripts, each with its own Lims instance,
+reading the same project tree from the stand-in server, directly and
+through the local caching proxy, and count the requests to the server.
+
+Usage: python proxy.py [SCRIPTS] [SAMPLES] [LATENCY]
+"""
+
+import sys
+import time
+import threading
+
+from genologics.lims import Lims
+from genologics.proxy import Proxy
+
+from standin import Server
+
+
+def script(baseuri):
+    "A short script: a new Lims instance reading a project tree."
+    lims = Lims(baseuri, 'user', 'password')
+    tree = lims.load_project_tree('P1', depth=4)
+    for sample in tree.samples:
+        container, well = sample.artifact.location
+        container.type.name
+
+
+def run(baseuri, scripts):
+    "Run the scripts, half of them concurrently, half one after another."
+    threads = [threading.Thread(target=script, args=(baseuri,))
+               for i in xrange(scripts // 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in xrange(scripts - scripts // 2):
+        script(baseuri)
+
+
+if __name__ == '__main__':
+    scripts = len(sys.argv) > 1 and int(sys.argv[1]) or 10
+    samples = len(sys.argv) > 2 and int(sys.argv[2]) or 1000
+    latency = len(sys.argv) > 3 and float(sys.argv[3]) or 0.01
+    server = Server(samples=samples, latency=latency)
+    server.start()
+    proxy = Proxy(server.baseuri, port=0)
+    proxy.start()
+    for name, baseuri in [('Direct', server.baseuri),
+                          ('Proxy', proxy.baseuri)]:
+        before = server.requests
+        start = time.time()
+        run(baseuri, scripts)
+        print "%-8s %6.2f s %6i requests to the server" % \
+              (name, time.time() - start, server.requests - before)
+    print 'Proxy', proxy.stats()
@@ -0,0 +1,228 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Stand-in server for benchmarks: serves a synthetic project with samples,
+their artifacts in 96-well plates, and related entities, with a fixed
+latency per request. Only the calls used by the benchmarks are handled.
+
+Usage: python standin.py [PORT] [SAMPLES] [LATENCY]
+       LATENCY in seconds per request.
+"""
+
+import re
+import sys
+import time
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from xml.etree import ElementTree
+
+PAGE_SIZE = 500
+WELLS = 96
+
+PROJECT = """<prj:project xmlns:prj="http://genologics.com/ri/project" \
+limsid="%(project)s" uri="%(base)sprojects/%(project)s">\
+<name>Project %(project)s</name><open-date>2012-01-01</open-date>\
+<researcher uri="%(base)sresearchers/1"/></prj:project>"""
+
+SAMPLE = """<smp:sample xmlns:smp="http://genologics.com/ri/sample" \
+xmlns:udf="http://genologics.com/ri/userdefined" \
+limsid="%(id)s" uri="%(base)ssamples/%(id)s"><name>P1_%(n)i</name>\
+<date-received>2012-01-02</date-received>\
+<project limsid="%(project)s" uri="%(base)sprojects/%(project)s"/>\
+<submitter uri="%(base)sresearchers/1"/>\
+<artifact limsid="%(artifact)s" uri="%(base)sartifacts/%(artifact)s?state=1"/>\
+<udf:field type="Numeric" name="Concentration">%(n)i</udf:field>\
+<udf:field type="String" name="Index">IDX%(index)i</udf:field>\
+</smp:sample>"""
+
+ARTIFACT = """<art:artifact xmlns:art="http://genologics.com/ri/artifact" \
+xmlns:udf="http://genologics.com/ri/userdefined" \
+limsid="%(artifact)s" uri="%(base)sartifacts/%(artifact)s?state=1">\
+<name>P1_%(n)i</name><type>Analyte</type><output-type>Analyte</output-type>\
+<qc-flag>PASSED</qc-flag><volume>10</volume><concentration>1.5</concentration>\
+<location><container limsid="%(container)s" \
+uri="%(base)scontainers/%(container)s"/><value>%(well)s</value></location>\
+<working-flag>true</working-flag>\
+<sample limsid="%(id)s" uri="%(base)ssamples/%(id)s"/>\
+<reagent-label name="IDX%(index)i"/>\
+<udf:field type="String" name="Flowcell">FC%(plate)i</udf:field>\
+</art:artifact>"""
+
+CONTAINER = """<con:container xmlns:con="http://genologics.com/ri/container" \
+limsid="%(container)s" uri="%(base)scontainers/%(container)s">\
+<name>Plate %(plate)i</name>\
+<type name="96 well plate" uri="%(base)scontainertypes/1"/>\
+<occupied-wells>%(occupied)i</occupied-wells>%(placements)s\
+<state>Populated</state></con:container>"""
+
+PLACEMENT = """<placement limsid="%(artifact)s" \
+uri="%(base)sartifacts/%(artifact)s?state=1"><value>%(well)s</value>\
+</placement>"""
+
+OTHERS = dict(
+    containertypes="""<ctp:container-type \
+xmlns:ctp="http://genologics.com/ri/containertype" name="96 well plate" \
+uri="%(base)scontainertypes/1"><x-dimension><is-alpha>false</is-alpha>\
+<offset>1</offset><size>12</size></x-dimension><y-dimension>\
+<is-alpha>true</is-alpha><offset>0</offset><size>8</size></y-dimension>\
+</ctp:container-type>""",
+    researchers="""<res:researcher \
+xmlns:res="http://genologics.com/ri/researcher" \
+uri="%(base)sresearchers/1"><first-name>Lab</first-name>\
+<last-name>Person</last-name><lab uri="%(base)slabs/1"/></res:researcher>""",
+    labs="""<lab:lab xmlns:lab="http://genologics.com/ri/lab" \
+uri="%(base)slabs/1"><name>The Lab</name></lab:lab>""")
+
+DETAILS = """<%(prefix)s:details xmlns:%(prefix)s="%(ns)s">%(items)s\
+</%(prefix)s:details>"""
+
+LIST = """<%(prefix)s:%(kind)s xmlns:%(prefix)s="%(ns)s">%(items)s%(next)s\
+</%(prefix)s:%(kind)s>"""
+
+NAMESPACES = dict(samples=('smp', 'http://genologics.com/ri/sample'),
+                  artifacts=('art', 'http://genologics.com/ri/artifact'),
+                  containers=('con', 'http://genologics.com/ri/container'))
+
+XML_DECL = re.compile(r'^<\?xml[^>]*>')
+
+
+class Data(object):
+    "The synthetic content: one project and its samples."
+
+    def __init__(self, base, samples):
+        self.base = base
+        self.samples = samples
+        self.project = 'P1'
+
+    def values(self, n):
+        "Return the template values for sample number n."
+        plate, pos = divmod(n, WELLS)
+        well = "%s:%i" % ('ABCDEFGH'[pos % 8], pos // 8 + 1)
+        return dict(base=self.base, project=self.project, n=n,
+                    id="P1S%i" % n, artifact="P1A%i" % n,
+                    container="27-%i" % plate, plate=plate,
+                    well=well, index=pos)
+
+    def get(self, kind, id):
+        "Return the XML for the entity, or None if there is none."
+        try:
+            if kind == 'projects' and id == self.project:
+                return PROJECT % dict(base=self.base, project=self.project)
+            elif kind == 'samples':
+                return SAMPLE % self.values(int(id[3:]))
+            elif kind == 'artifacts':
+                return ARTIFACT % self.values(int(id[3:]))
+            elif kind == 'containers':
+                plate = int(id.split('-')[1])
+                first = plate * WELLS
+                last = min(first + WELLS, self.samples)
+                placements = [PLACEMENT % self.values(n)
+                              for n in xrange(first, last)]
+                values = self.values(first)
+                values.update(occupied=len(placements),
+                              placements=''.join(placements))
+                return CONTAINER % values
+            elif kind in OTHERS and id == '1':
+                return OTHERS[kind] % dict(base=self.base)
+        except (ValueError, IndexError):
+            pass
+        return None
+
+    def list_samples(self, query):
+        "Return the XML for the page of the sample list."
+        start = int(query.get('start-index', ['0'])[0])
+        end = min(start + PAGE_SIZE, self.samples)
+        items = ['<sample limsid="P1S%i" uri="%ssamples/P1S%i"/>' %
+                 (n, self.base, n) for n in xrange(start, end)]
+        next = ''
+        if end < self.samples:
+            next = '<next-page uri="%ssamples?projectlimsid=%s&amp;' \
+                   'start-index=%i"/>' % (self.base, self.project, end)
+        return LIST % dict(prefix='smp', kind='samples',
+                           ns=NAMESPACES['samples'][1],
+                           items=''.join(items), next=next)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, content):
+        self.server.count()
+        time.sleep(self.server.latency)
+        if content is None:
+            content = '<exc:exception ' \
+                'xmlns:exc="http://genologics.com/ri/exception">' \
+                '<message>Not found</message></exc:exception>'
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        parts = urlparse.urlparse(self.path)
+        segments = parts.path.strip('/').split('/')[2:]
+        if segments == ['samples']:
+            self.respond(self.server.data.list_samples(
+                    urlparse.parse_qs(parts.query)))
+        elif len(segments) == 2:
+            self.respond(self.server.data.get(*segments))
+        else:
+            self.respond(None)
+
+    def do_POST(self):
+        segments = self.path.strip('/').split('/')[2:]
+        data = self.rfile.read(int(self.headers.getheader('content-length')))
+        if len(segments) != 3 or segments[1:] != ['batch', 'retrieve'] or \
+           segments[0] not in NAMESPACES:
+            self.respond(None)
+            return
+        kind = segments[0]
+        items = []
+        for node in ElementTree.fromstring(data).findall('link'):
+            path = urlparse.urlparse(node.attrib['uri']).path
+            xml = self.server.data.get(kind, path.split('/')[-1])
+            if xml is not None:
+                items.append(XML_DECL.sub('', xml))
+        prefix, ns = NAMESPACES[kind]
+        self.respond(DETAILS % dict(prefix=prefix, ns=ns, items=''.join(items)))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    "Threaded stand-in server, counting the requests it handles."
+
+    daemon_threads = True
+
+    def __init__(self, port=0, samples=1000, latency=0.01):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port), Handler)
+        self.latency = latency
+        self.baseuri = "http://localhost:%i/" % self.server_address[1]
+        self.data = Data(self.baseuri + 'api/v1/', samples)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        "Serve in a background thread."
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+if __name__ == '__main__':
+    port = len(sys.argv) > 1 and int(sys.argv[1]) or 8080
+    samples = len(sys.argv) > 2 and int(sys.argv[2]) or 1000
+    latency = len(sys.argv) > 3 and float(sys.argv[3]) or 0.01
+    server = Server(port, samples, latency)
+    print 'Serving', server.baseuri
+    server.serve_forever()
@@ -0,0 +1,72 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Benchmark: Throughput of the XML backends for parsing a batch response,
+looking up the elements read by the descriptors, and serializing.
+No server is needed; the batch response is synthetic.
+
+Usage: python xml_backends.py [ARTIFACTS]
+"""
+
+import sys
+import time
+
+from batch_parse import ARTIFACT
+
+UDF_FIELD = '{http://genologics.com/ri/userdefined}field'
+
+
+def get_backends():
+    "Return the list of (name, module) for the installed backends."
+    result = []
+    try:
+        from lxml import etree
+        result.append(('lxml', etree))
+    except ImportError:
+        pass
+    from xml.etree import cElementTree
+    result.append(('cElementTree', cElementTree))
+    from xml.etree import ElementTree
+    result.append(('ElementTree', ElementTree))
+    return result
+
+
+def lookup(root):
+    "Find the elements read by the Artifact descriptors."
+    for node in root:
+        node.find('name').text
+        node.find('qc-flag').text
+        node.find('location/value').text
+        node.find('sample').attrib['uri']
+        for field in node.findall(UDF_FIELD):
+            field.attrib['name']
+
+
+def run(module, content, repeat=3):
+    "Return the best time for parse, lookup and serialize."
+    times = [[], [], []]
+    for i in xrange(repeat):
+        start = time.time()
+        root = module.fromstring(content)
+        times[0].append(time.time() - start)
+        start = time.time()
+        lookup(root)
+        times[1].append(time.time() - start)
+        start = time.time()
+        for node in root:
+            module.tostring(node, encoding='UTF-8')
+        times[2].append(time.time() - start)
+    return [min(t) for t in times]
+
+
+if __name__ == '__main__':
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+    content = '<art:details xmlns:art="http://genologics.com/ri/artifact">' \
+        '%s</art:details>' % ''.join([ARTIFACT % dict(id="A%i" % n, n=n)
+                                       for n in xrange(count)])
+    print "%i artifacts, %.1f MB" % (count, len(content) / 1e6)
+    print "%-14s %14s %14s %14s" % ('backend', 'parse/s',
+                                    'lookup/s', 'serialize/s')
+    for name, module in get_backends():
+        parse, find, serialize = run(module, content)
+        print "%-14s %14i %14i %14i" % (name, count / parse,
+                                        count / find, count / serialize)
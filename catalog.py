@@ -0,0 +1,137 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Catalog of the small, slow-changing reference entities.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import hashlib
+import threading
+
+from .entities import Containertype, Processtype, Lab, Researcher
+
+
+class Catalog(object):
+    """All container types, process types, labs and researchers, loaded
+    in bulk and indexed by id and name. Since these are in the cache of
+    the Lims instance, references to them from other entities are
+    resolved without any further requests. An instance that has been
+    modified locally, and not saved, is not reloaded by a later 'load'.
+    """
+
+    CLASSES = (Containertype, Processtype, Lab, Researcher)
+
+    def __init__(self, lims):
+        self.lims = lims
+        self.lock = threading.Lock()
+        self._by_id = dict()
+        self._by_name = dict()
+        self._digests = dict()          # key -> MD5 digest of loaded XML
+        self._thread = None
+        self._stop = threading.Event()
+
+    def load(self, force=True):
+        """Get the lists of all instances of the catalog classes, and load
+        their content. Existing instances are reloaded if force, except
+        those modified locally since loaded by the catalog."""
+        lists = dict()
+        lists[Containertype] = self.lims.get_containertypes()
+        lists[Processtype] = self.lims.get_processtypes()
+        lists[Lab] = self.lims.get_labs()
+        lists[Researcher] = self.lims.get_researchers()
+        instances = []
+        for klass in self.CLASSES:
+            instances.extend(lists[klass])
+        with self.lock:
+            previous = dict(self._digests)
+        modified = [i for i in instances if self._is_modified(i, previous)]
+        keys = set([i.key for i in modified])
+        self.lims.load_batch([i for i in instances if i.key not in keys],
+                             force=force)
+        by_id = dict()
+        by_name = dict()
+        digests = dict()
+        for klass in self.CLASSES:
+            for instance in lists[klass]:
+                by_id[(klass, instance.id)] = instance
+                by_name[(klass, instance.name)] = instance
+                if instance.key in keys:
+                    digests[instance.key] = previous[instance.key]
+                else:
+                    digests[instance.key] = self._get_digest(instance)
+        with self.lock:
+            self._by_id = by_id
+            self._by_name = by_name
+            self._digests = digests
+
+    def loaded(self, instance):
+        """Record the content of the instance, if in the catalog, as that
+        loaded from or saved to the server; called by the Lims instance."""
+        if instance.__class__ not in self.CLASSES: return
+        with self.lock:
+            if instance.key not in self._digests: return
+        digest = self._get_digest(instance)
+        with self.lock:
+            if instance.key in self._digests:
+                self._digests[instance.key] = digest
+
+    def _get_digest(self, instance):
+        "Return the digest of the XML of the instance, or None if none."
+        xml = instance.snapshot().xml
+        if xml is None: return None
+        return hashlib.md5(xml).hexdigest()
+
+    def _is_modified(self, instance, digests):
+        "Has the instance been modified since loaded by the catalog?"
+        digest = digests.get(instance.key)
+        if digest is None or instance.root is None: return False
+        return self._get_digest(instance) != digest
+
+    def get(self, klass, id=None, name=None):
+        """Return the instance of the catalog class having the given id
+        or name, or None if not in the catalog."""
+        with self.lock:
+            if id is not None:
+                return self._by_id.get((klass, id))
+            return self._by_name.get((klass, name))
+
+    def get_containertype(self, name):
+        "Return the container type having the given name, or None."
+        return self.get(Containertype, name=name)
+
+    def get_processtype(self, name):
+        "Return the process type having the given name, or None."
+        return self.get(Processtype, name=name)
+
+    def get_lab(self, name):
+        "Return the lab having the given name, or None."
+        return self.get(Lab, name=name)
+
+    def get_researcher(self, name):
+        "Return the researcher having the given full name, or None."
+        return self.get(Researcher, name=name)
+
+    def start(self, interval):
+        """Reload the catalog every 'interval' seconds in a background thread,
+        making the requests in the 'bulk' lane."""
+        self.stop()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Stop the background reloading, if running."
+        if self._thread is None: return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                with self.lims.priority('bulk'):
+                    self.load()
+            except Exception:           # Keep the current catalog; retry.
+                pass
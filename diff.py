@@ -0,0 +1,135 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Snapshots of sets of entities, and the differences between them.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import time
+import hashlib
+import collections
+
+from .entities import *
+
+# The entity classes whose get_* method has the 'last_modified' filter.
+MODIFIED = (Lab, Researcher, Project, Container, Process, Artifact)
+
+# The state of an instance in a SetSnapshot.
+# digest: MD5 hex digest of its XML.
+# fields: Dictionary of the selected fields to their values.
+Entry = collections.namedtuple('Entry', ['digest', 'fields'])
+
+# The differences between two snapshots of a set.
+# added, removed: Sorted lists of LIMS ids.
+# changed: Dictionary of LIMS id to a dictionary of field to (old, new)
+#          value, for the instances whose XML changed. The latter is empty
+#          if none of the selected fields changed.
+Diff = collections.namedtuple('Diff', ['added', 'removed', 'changed'])
+
+
+class SetSnapshot(object):
+    """A compact, picklable snapshot of the set of instances of an entity
+    class given by the filters of its get_* method: the digest of the XML
+    of each instance, and the values of the selected fields. Entities in
+    the values are represented by their LIMS ids.
+    """
+
+    def __init__(self, klass, filters, fields, time, entries):
+        self.klass = klass
+        self.filters = filters
+        self.fields = fields
+        self.time = time                # Seconds since the epoch.
+        self.entries = entries          # LIMS id -> Entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def capture(cls, lims, klass, fields=[], **filters):
+        """Get the instances of the class from the server, and return the
+        snapshot of them.
+        fields: List of attribute names, and 'udf:NAME' for UDF values.
+        filters: Keyword arguments for the get_* method of the class.
+        """
+        now = time.time()
+        method = getattr(lims, "get_%s" % klass._URI)
+        instances = method(**filters)
+        result = cls(klass, filters, list(fields), now, dict())
+        result._add(lims, instances)
+        return result
+
+    def _add(self, lims, instances):
+        "Load the instances from the server, and set their entries."
+        lims.load_batch(instances, force=True)
+        for instance in instances:
+            instance.get()
+            xml = ElementTree.tostring(instance.root, encoding='UTF-8')
+            values = dict()
+            for field in self.fields:
+                values[field] = self._get_value(instance, field)
+            self.entries[instance.id] = Entry(hashlib.md5(xml).hexdigest(),
+                                              values)
+
+    def _get_value(self, instance, field):
+        if field.startswith('udf:'):
+            try:
+                return instance.udf[field[4:]]
+            except KeyError:
+                return None
+        return self._convert(getattr(instance, field))
+
+    def _convert(self, value):
+        "Convert entities in the value to their LIMS ids."
+        if isinstance(value, Entity):
+            return value.id
+        elif isinstance(value, (list, tuple)):
+            return type(value)([self._convert(v) for v in value])
+        return value
+
+    def diff(self, other):
+        "Return the Diff from this snapshot to the other, later one."
+        old = set(self.entries)
+        new = set(other.entries)
+        changed = dict()
+        for id in old.intersection(new):
+            before = self.entries[id]
+            after = other.entries[id]
+            if before.digest == after.digest: continue
+            fields = dict()
+            for field, value in after.fields.iteritems():
+                previous = before.fields.get(field)
+                if previous != value:
+                    fields[field] = (previous, value)
+            changed[id] = fields
+        return Diff(sorted(new - old), sorted(old - new), changed)
+
+    def diff_live(self, lims, overlap=60.0):
+        """Compare this snapshot with the current state on the server.
+        Return a tuple (Diff, SetSnapshot) of the differences and the
+        new snapshot. The current set is obtained as LIMS ids only. Only
+        the added instances, and for classes having the 'last_modified'
+        filter those modified since this snapshot, are fetched using batch
+        calls and compared. For other classes all instances are fetched.
+        overlap: Seconds by which to set back the time of this snapshot,
+                 to allow for clock differences.
+        """
+        now = time.time()
+        method = getattr(lims, "get_%s" % self.klass._URI)
+        ids = set(method(mode='ids', **self.filters))
+        if self.klass in MODIFIED:
+            since = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                  time.gmtime(self.time - overlap))
+            candidates = set(method(last_modified=since, mode='ids',
+                                    **self.filters))
+            candidates.intersection_update(ids)
+            candidates.update(ids.difference(self.entries))
+        else:
+            candidates = ids
+        entries = dict([(id, self.entries[id])
+                        for id in ids.difference(candidates)])
+        result = SetSnapshot(self.klass, self.filters, self.fields, now,
+                             entries)
+        result._add(lims, [lims._get_instance(self.klass, id)
+                           for id in sorted(candidates)])
+        return self.diff(result), result
@@ -0,0 +1,341 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Command-line tool to dump the instances of entity classes to files, as
+JSON Lines, XML or Parquet. The instances are retrieved in chunks using
+batch calls, several chunks at a time. Each chunk is written to its own
+file once complete, so an interrupted dump continues where it stopped
+when run again with the same arguments.
+
+Usage: python -m genologics.dump --output DIR samples artifacts
+       python -m genologics.dump --help
+
+The server and account are given by options, or by the environment
+variables GENOLOGICS_BASEURI, GENOLOGICS_USERNAME and GENOLOGICS_PASSWORD.
+Parquet output requires the 'pyarrow' package.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .lims import Lims
+from .entities import *
+
+# The entity classes that can be dumped, by the name of their list.
+CLASSES = dict([(klass._URI, klass)
+                for klass in (Lab, Researcher, Project, Sample, Artifact,
+                              Containertype, Container, Processtype,
+                              Process)])
+
+FORMATS = ('jsonl', 'xml', 'parquet')
+
+
+class Dump(object):
+    """Dump the instances of an entity class given by filters into files
+    in a directory, in chunks of 'chunk_size' instances, 'workers' chunks
+    concurrently. The LIMS ids are listed first, into 'ids.txt'; chunk N
+    is written to 'part-N.FORMAT'. Existing files are kept, which makes
+    the dump resume from the first chunk not written. The class, filters
+    and chunk size are recorded in 'dump.json'; a dump cannot be resumed
+    with others.
+    """
+
+    def __init__(self, lims, klass, directory, format='jsonl', filters=dict(),
+                 chunk_size=None, workers=4):
+        if format not in FORMATS:
+            raise ValueError("invalid format '%s'" % format)
+        self.lims = lims
+        self.klass = klass
+        self.directory = directory
+        self.format = format
+        self.filters = filters
+        self.chunk_size = chunk_size or lims.BATCH_SIZE
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.total = 0                  # Number of instances to dump.
+        self.skipped = 0                # Number dumped by a previous run.
+        self.written = 0                # Number dumped by this run.
+        self.bytes = 0                  # Bytes written by this run.
+        self.start = None
+
+    def get_ids(self):
+        """Return the list of LIMS ids to dump, from 'ids.txt' if it exists,
+        otherwise from the server, saving them."""
+        path = os.path.join(self.directory, 'ids.txt')
+        if os.path.exists(path):
+            with open(path) as infile:
+                return [line.strip() for line in infile if line.strip()]
+        method = getattr(self.lims, "get_%s" % self.klass._URI)
+        ids = list(method(mode='ids', **self.filters))
+        with open(path + '.part', 'w') as outfile:
+            for id in ids:
+                outfile.write(id + '\n')
+        os.rename(path + '.part', path)
+        return ids
+
+    def get_state(self):
+        """Return the arguments that determine the files, as recorded
+        in 'dump.json'."""
+        filters = dict()
+        for name, value in self.filters.iteritems():
+            if isinstance(value, (list, tuple, set)):
+                value = sorted(value)
+            filters[name] = value
+        state = {'class': self.klass._URI, 'filters': filters,
+                 'chunk_size': self.chunk_size}
+        return json.loads(json.dumps(state))
+
+    def check_state(self):
+        """Record the class, filters and chunk size in 'dump.json', or if
+        recorded by a previous run, raise ValueError if any differs, since
+        the existing files then do not correspond to the chunks."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, 'dump.json')
+        state = self.get_state()
+        if os.path.exists(path):
+            with open(path) as infile:
+                previous = json.load(infile)
+            for name in sorted(state):
+                if previous.get(name) != state[name]:
+                    raise ValueError("%s %s differs from %s of the previous "
+                                     "run in '%s'" %
+                                     (name.replace('_', ' '),
+                                      json.dumps(state[name]),
+                                      json.dumps(previous.get(name)),
+                                      self.directory))
+            return
+        with open(path + '.part', 'w') as outfile:
+            json.dump(state, outfile)
+        os.rename(path + '.part', path)
+
+    def get_path(self, number):
+        return os.path.join(self.directory,
+                            "part-%05i.%s" % (number, self.format))
+
+    def run(self, progress=None):
+        """Dump the instances not already dumped. Call the progress function,
+        if any, with this instance after each chunk."""
+        self.check_state()
+        self.start = time.time()
+        ids = self.get_ids()
+        self.total = len(ids)
+        chunks = []
+        for number, pos in enumerate(xrange(0, len(ids), self.chunk_size)):
+            chunk = ids[pos:pos+self.chunk_size]
+            if os.path.exists(self.get_path(number)):
+                self.skipped += len(chunk)
+            else:
+                chunks.append((number, chunk))
+        def write(args):
+            self.write_chunk(*args)
+            if progress is not None:
+                progress(self)
+        if len(chunks) <= 1 or self.workers <= 1:
+            for args in chunks:
+                write(args)
+        else:
+            pool = ThreadPool(min(self.workers, len(chunks)))
+            try:
+                pool.map(write, chunks)
+            finally:
+                pool.close()
+
+    def write_chunk(self, number, ids):
+        "Retrieve the instances for the ids, and write them to the file."
+        instances = [self.lims._get_instance(self.klass, id) for id in ids]
+        self.lims.load_batch(instances, force=True)
+        path = self.get_path(number)
+        references = []                 # Instances referenced by records.
+        if self.format == 'jsonl':
+            self.write_jsonl(path + '.part', instances, references)
+        elif self.format == 'xml':
+            self.write_xml(path + '.part', instances)
+        else:
+            self.write_parquet(path + '.part', instances, references)
+        size = os.path.getsize(path + '.part')
+        os.rename(path + '.part', path)
+        # Keep the memory use flat over the whole dump.
+        with self.lims.lock:
+            for instance in instances + references:
+                self.lims.cache.pop(instance.key, None)
+        with self.lock:
+            self.written += len(instances)
+            self.bytes += size
+
+    def write_jsonl(self, path, instances, references):
+        with open(path, 'wb') as outfile:
+            for instance in instances:
+                outfile.write(json.dumps(get_record(instance, references)))
+                outfile.write('\n')
+
+    def write_xml(self, path, instances):
+        with open(path, 'wb') as outfile:
+            outfile.write("<?xml version='1.0' encoding='UTF-8'?>\n<dump>\n")
+            for instance in instances:
+                instance.get()
+                outfile.write(ElementTree.tostring(instance.root,
+                                                   encoding='UTF-8')
+                              .split('?>', 1)[-1].strip())
+                outfile.write('\n')
+            outfile.write('</dump>\n')
+
+    def write_parquet(self, path, instances, references):
+        """Write the records as a Parquet table. Values that are not
+        scalars, such as UDF dictionaries, are stored as JSON strings."""
+        import pyarrow
+        import pyarrow.parquet
+        records = [get_record(instance, references) for instance in instances]
+        names = sorted(set([key for r in records for key in r]))
+        columns = dict()
+        for name in names:
+            values = []
+            for record in records:
+                value = record.get(name)
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value)
+                values.append(value)
+            columns[name] = values
+        table = pyarrow.Table.from_pydict(columns)
+        pyarrow.parquet.write_table(table, path)
+
+    def get_rate(self):
+        "Return the number of instances dumped per second by this run."
+        elapsed = time.time() - self.start
+        if elapsed <= 0: return 0.0
+        return self.written / elapsed
+
+
+def get_record(instance, references=None):
+    """Return a dictionary of the attribute values of the instance, with
+    the entities they reference given by LIMS id, for output as JSON.
+    The instances of these entities are appended to the references list,
+    if given. An attribute whose XML element is missing has value None."""
+    instance.get()
+    result = dict(id=instance.id, uri=instance.uri)
+    for klass in reversed(instance.__class__.__mro__):
+        for name, descriptor in klass.__dict__.iteritems():
+            if not isinstance(descriptor, BaseDescriptor): continue
+            if _is_missing(instance, descriptor):
+                value = None
+            else:
+                value = getattr(instance, name)
+            result[name] = _convert(value, references)
+    return result
+
+
+def _is_missing(instance, descriptor):
+    """Is the XML element or attribute missing that the descriptor
+    requires to give a value?"""
+    if isinstance(descriptor, StringAttributeDescriptor):
+        return descriptor.tag not in instance.root.attrib
+    elif isinstance(descriptor, (DimensionDescriptor, EntityDescriptor)) \
+         and not isinstance(descriptor, EntityListDescriptor):
+        return instance.root.find(descriptor.tag) is None
+    return False
+
+
+def _convert(value, references=None):
+    """Convert the value for output as JSON. Append the entity instances
+    in it to the references list, if given."""
+    if isinstance(value, Entity):
+        if references is not None:
+            references.append(value)
+        return value.id
+    elif isinstance(value, UdfDictionary):
+        return _convert(dict(value.items()), references)
+    elif isinstance(value, dict):
+        return dict([(k, _convert(v, references))
+                     for k, v in value.iteritems()])
+    elif isinstance(value, (list, tuple)):
+        return [_convert(v, references) for v in value]
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Dump instances of entity classes from GenoLogics LIMS.')
+    parser.add_argument('classes', nargs='+', metavar='CLASS',
+                        choices=sorted(CLASSES),
+                        help="entity class, by list name: %s" %
+                        ', '.join(sorted(CLASSES)))
+    parser.add_argument('--output', '-o', required=True,
+                        help='directory for the files; one per class')
+    parser.add_argument('--format', '-f', choices=FORMATS, default='jsonl')
+    parser.add_argument('--filter', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='filter for the get_* methods, such as '
+                        'projectlimsid=KRA61; repeat a name for several '
+                        'values')
+    parser.add_argument('--chunk-size', type=int, default=Lims.BATCH_SIZE,
+                        help='instances per batch call and file')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='chunks retrieved concurrently')
+    parser.add_argument('--restart', action='store_true',
+                        help='discard the files of a previous run')
+    parser.add_argument('--baseuri',
+                        default=os.environ.get('GENOLOGICS_BASEURI'))
+    parser.add_argument('--username',
+                        default=os.environ.get('GENOLOGICS_USERNAME'))
+    parser.add_argument('--password',
+                        default=os.environ.get('GENOLOGICS_PASSWORD'))
+    options = parser.parse_args(args)
+    if not (options.baseuri and options.username and options.password):
+        parser.error('the base URI, username and password are required')
+    if options.format == 'parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            parser.error("the 'parquet' format requires 'pyarrow'")
+    filters = dict()
+    for item in options.filter:
+        try:
+            name, value = item.split('=', 1)
+        except ValueError:
+            parser.error("invalid filter '%s'" % item)
+        filters.setdefault(name, []).append(value)
+    for name, values in filters.items():
+        if len(values) == 1:
+            filters[name] = values[0]
+
+    lims = Lims(options.baseuri, options.username, options.password,
+                threads=options.workers, lanes=dict(bulk=options.workers))
+    for name in options.classes:
+        directory = os.path.join(options.output, name)
+        if options.restart and os.path.isdir(directory):
+            shutil.rmtree(directory)
+        dump = Dump(lims, CLASSES[name], directory, format=options.format,
+                    filters=filters, chunk_size=options.chunk_size,
+                    workers=options.workers)
+        try:
+            dump.check_state()
+        except ValueError, error:
+            parser.error("%s; use --restart to discard it" % error)
+        dump.run(progress=_progress)
+        sys.stderr.write("\n%s: %i dumped, %i from previous run, "
+                         "%.1f MB in %.1f s, %.1f per second\n" %
+                         (name, dump.written, dump.skipped,
+                          dump.bytes / 1e6, time.time() - dump.start,
+                          dump.get_rate()))
+
+
+def _progress(dump):
+    done = dump.written + dump.skipped
+    sys.stderr.write("\r%s: %i/%i (%.0f%%), %.1f per second" %
+                     (dump.klass._URI, done, dump.total,
+                      100.0 * done / max(dump.total, 1), dump.get_rate()))
+
+
+if __name__ == '__main__':
+    main()
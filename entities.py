@@ -6,12 +6,32 @@ Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
 Copyright (C) 2012 Per Kraulis
 """
 
+import os
 import re
 import codecs
 import urlparse
 import datetime
 import time
-from xml.etree import ElementTree
+import collections
+
+# The XML backend is chosen by the environment variable
+# GENOLOGICS_XML_BACKEND: 'lxml', 'cElementTree' or 'ElementTree'.
+# By default lxml is used if installed, otherwise cElementTree.
+XML_BACKEND = os.environ.get('GENOLOGICS_XML_BACKEND')
+if XML_BACKEND in (None, 'lxml'):
+    try:
+        from lxml import etree as ElementTree
+        XML_BACKEND = 'lxml'
+    except ImportError:
+        if XML_BACKEND == 'lxml': raise
+        XML_BACKEND = None
+if XML_BACKEND in (None, 'cElementTree'):
+    from xml.etree import cElementTree as ElementTree
+    XML_BACKEND = 'cElementTree'
+elif XML_BACKEND == 'ElementTree':
+    from xml.etree import ElementTree
+elif XML_BACKEND != 'lxml':
+    raise ImportError("unknown XML backend '%s'" % XML_BACKEND)
 
 
 _NSMAP = dict(
@@ -38,7 +58,7 @@ _NSMAP = dict(
     ver='http://genologics.com/ri/version')
 
 for prefix, uri in _NSMAP.iteritems():
-    ElementTree._namespace_map[uri] = prefix
+    ElementTree.register_namespace(prefix, uri)
 
 _NSPATTERN = re.compile(r'(\{)(.+?)(\})')
 
@@ -49,6 +69,43 @@ def nsmap(tag):
         raise ValueError("no namespace specifier in tag")
     return "{%s}%s" % (_NSMAP[parts[0]], parts[1])
 
+# Namespace tags used at run time, converted once.
+UDF_FIELD  = nsmap('udf:field')
+UDF_TYPE   = nsmap('udf:type')
+EXTERNALID = nsmap('ri:externalid')
+
+
+# Picklable snapshot of an entity instance: its class, id, and the XML
+# string for its content, or None if not loaded.
+Snapshot = collections.namedtuple('Snapshot', ['klass', 'id', 'xml', 'state'])
+
+
+def _projected(get):
+    """Decorator for the __get__ method of a descriptor: return the value
+    kept by a projected instance, if any; see Entity.project_fields.
+    Otherwise the instance is loaded in full, as usual, and the read is
+    reported to the prefetcher of the Lims instance, if any."""
+    def __get__(self, instance, cls):
+        fields = instance.fields
+        if fields is not None:
+            try:
+                value = fields[self]
+            except KeyError:
+                pass
+            else:
+                if isinstance(self, UdfDictionaryDescriptor):
+                    return _ProjectedUdfDictionary(instance, value)
+                return value
+        prefetcher = instance.lims.prefetcher
+        if prefetcher is None:
+            return get(self, instance, cls)
+        prefetcher.used(instance)
+        value = get(self, instance, cls)
+        prefetcher.accessed(instance, self, value)
+        return value
+    __get__.__doc__ = get.__doc__
+    return __get__
+
 
 class BaseDescriptor(object):
     "Abstract base descriptor for an instance attribute."
@@ -72,12 +129,14 @@ class StringDescriptor(TagDescriptor):
     """
 
     def __set__(self, instance, value):
+        instance.get()
         node = instance.root.find(self.tag)
         if node is None:
             raise AttributeError("no element '%s' to set" % self.tag)
         else:
             node.text = value
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         node = instance.root.find(self.tag)
@@ -92,6 +151,7 @@ class StringAttributeDescriptor(TagDescriptor):
     represented by an XML attribute.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         return instance.root.attrib[self.tag]
@@ -102,6 +162,7 @@ class StringListDescriptor(TagDescriptor):
     represented by multiple XML elements.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         result = []
@@ -115,6 +176,7 @@ class StringDictionaryDescriptor(TagDescriptor):
     represented by a hierarchical XML element.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         result = dict()
@@ -130,6 +192,7 @@ class IntegerDescriptor(StringDescriptor):
     represented by an XMl element.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         node = instance.root.find(self.tag)
@@ -159,7 +222,7 @@ class UdfDictionary(object):
         if not self._udt:
             raise AttributeError('cannot set name for a UDF dictionary')
         self._udt = name
-        elem = self.instance.root.find(nsmap('udf:type'))
+        elem = self.instance.root.find(UDF_TYPE)
         assert elem is not None
         elem.set('name', name)
 
@@ -168,14 +231,13 @@ class UdfDictionary(object):
     def _update_elems(self):
         self._elems = []
         if self._udt:
-            elem = self.instance.root.find(nsmap('udf:type'))
+            elem = self.instance.root.find(UDF_TYPE)
             if elem is not None:
                 self._udt = elem.attrib['name']
-                self._elems = elem.findall(nsmap('udf:field'))
+                self._elems = elem.findall(UDF_FIELD)
         else:
-            tag = nsmap('udf:field')
             for elem in self.instance.root.getchildren():
-                if elem.tag == tag:
+                if elem.tag == UDF_FIELD:
                     self._elems.append(elem)
 
     def _prepare_lookup(self):
@@ -233,34 +295,36 @@ class UdfDictionary(object):
         else:                           # Create new entry; heuristics for type
             if isinstance(value, basestring):
                 type = '\n' in value and 'Text' or 'String'
-            elif isinstance(value, (int, float)):
-                type = 'Numeric'
             elif isinstance(value, bool):
                 type = 'Boolean'
                 value = value and 'True' or 'False'
+            elif isinstance(value, (int, float)):
+                type = 'Numeric'
+                value = str(value)
             elif isinstance(value, datetime.date):
                 type = 'Date'
                 value = str(value)
             else:
                 raise NotImplementedError("Cannot handle value of type '%s'"
-                                          " for UDF" % type(value))
+                                          " for UDF" % value.__class__)
             if self._udt:
-                root = self._instance.root.find(nsmap('udf:type'))
+                root = self.instance.root.find(UDF_TYPE)
             else:
-                root = self._instance.root
+                root = self.instance.root
             elem = ElementTree.SubElement(root,
-                                          nsmap('udf:field'),
+                                          UDF_FIELD,
                                           type=type,
                                           name=key)
             if not isinstance(value, unicode):
                 value = unicode(value, 'UTF-8')
             elem.text = value
+            self._elems.append(elem)
 
     def __delitem__(self, key):
         del self._lookup[key]
         for node in self._elems:
             if node.attrib['name'] == key:
-                self._instance.root.remove(node)
+                self.instance.root.remove(node)
                 break
 
     def items(self):
@@ -272,11 +336,41 @@ class UdfDictionary(object):
         self._update_elems()
 
 
+class _ProjectedUdfDictionary(UdfDictionary):
+    """The UDF values kept by a projected instance. A modification loads
+    the instance in full, and is then made in its UDF dictionary."""
+
+    def __init__(self, instance, values):
+        self.instance = instance
+        self._udt = False
+        self._elems = []
+        self._lookup = values
+
+    def _get_full(self):
+        self.instance.get()
+        return UdfDictionary(self.instance)
+
+    def __setitem__(self, key, value):
+        udf = self._get_full()
+        udf[key] = value
+        self._lookup = udf._lookup
+
+    def __delitem__(self, key):
+        udf = self._get_full()
+        del udf[key]
+        self._lookup = udf._lookup
+
+    def clear(self):
+        self._get_full().clear()
+        self._lookup = dict()
+
+
 class UdfDictionaryDescriptor(BaseDescriptor):
     """An instance attribute containing a dictionary of UDF values
     represented by multiple XML elements.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         return UdfDictionary(instance)
@@ -287,6 +381,7 @@ class UdtDictionaryDescriptor(UdfDictionaryDescriptor):
     in a UDT represented by multiple XML elements.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         return UdfDictionary(instance, udt=True)
@@ -297,6 +392,7 @@ class PlacementDictionaryDescriptor(TagDescriptor):
     keys and artifact values represented by multiple XML elements.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         result = dict()
@@ -309,17 +405,33 @@ class PlacementDictionaryDescriptor(TagDescriptor):
 
 class ExternalidListDescriptor(BaseDescriptor):
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         result = []
-        for node in instance.root.findall(nsmap('ri:externalid')):
+        for node in instance.root.findall(EXTERNALID):
             result.append((node.attrib.get('id'), node.attrib.get('uri')))
         return result
 
 
+class ReagentLabelListDescriptor(TagDescriptor):
+    """An instance attribute containing a list of reagent label names
+    represented by multiple XML elements.
+    """
+
+    @_projected
+    def __get__(self, instance, cls):
+        instance.get()
+        result = []
+        for node in instance.root.findall(self.tag):
+            result.append(node.attrib['name'])
+        return result
+
+
 class StateDescriptor(BaseDescriptor):
     "An instance attribute for Artifact state extracted from the URI."
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         uri = instance.root.attrib['uri']
@@ -349,6 +461,7 @@ class EntityDescriptor(TagDescriptor):
         super(EntityDescriptor, self).__init__(tag)
         self.klass = klass
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         node = instance.root.find(self.tag)
@@ -363,6 +476,7 @@ class EntityListDescriptor(EntityDescriptor):
     represented by multiple XML elements.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         result = []
@@ -379,6 +493,7 @@ class DimensionDescriptor(TagDescriptor):
     the properties of a dimension of a container type.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         node = instance.root.find(self.tag)
@@ -389,12 +504,16 @@ class DimensionDescriptor(TagDescriptor):
 
 class LocationDescriptor(TagDescriptor):
     """An instance attribute containing a tuple (container, value)
-    specifying the location of an analyte in a container.
+    specifying the location of an analyte in a container,
+    or None if it has no location.
     """
 
+    @_projected
     def __get__(self, instance, cls):
         instance.get()
         node = instance.root.find(self.tag)
+        if node is None:
+            return None
         id = node.find('container').attrib['limsid']
         container = instance.lims._get_instance(Container, id)
         value = node.find('value').text
@@ -406,11 +525,16 @@ class Entity(object):
 
     _TAG = None
     _URI = None
+    _BATCH = False                      # Does the API have batch calls?
+    _PREFIX = None                      # Namespace prefix of batch create.
 
     def __init__(self, lims, id=None):
         self.lims = lims
         self.id = id
         self.root = None
+        self.xml = None                 # Unparsed XML, if obtained in batch.
+        self.fields = None              # Values kept by a projection.
+        self.projection = None          # Names of the fields kept by it.
         if self.id:
             lims.cache[self.key] = self
 
@@ -435,16 +559,76 @@ class Entity(object):
 
     def get(self, force=False):
         if not force and self.root is not None: return
-        self.root = self.lims.get(self.uri)
-        self.parse()
+        self.lims.load(self, force=force)
 
     def parse(self):
         pass
 
+    def project_fields(self, fields):
+        """Keep only the values of the given fields, and discard the XML.
+        fields: List of attribute names, and of 'udf:NAME' for UDF values.
+        Other attributes, and any modification, cause the instance to be
+        loaded in full again. The 'udf' attribute of a projected instance
+        contains the projected UDF values only, until modified.
+        """
+        self.set_projection(fields, self.get_projection(fields))
+
+    def get_projection(self, fields):
+        """Return the dictionary of the values of the fields, by attribute
+        name, the UDF values as a dictionary for 'udf'; see project_fields."""
+        result = dict()
+        udf = dict()
+        for field in fields:
+            if field.startswith('udf:'):
+                try:
+                    udf[field[4:]] = self.udf[field[4:]]
+                except KeyError:
+                    udf[field[4:]] = None
+            else:
+                self._get_descriptor(field)
+                result[field] = getattr(self, field)
+        if udf:
+            result['udf'] = udf
+        return result
+
+    def set_projection(self, fields, values):
+        """Keep the values of the fields, as given by get_projection,
+        and discard the XML; see project_fields."""
+        result = dict()
+        for field, value in values.iteritems():
+            result[self._get_descriptor(field)] = value
+        self.fields = result
+        if not isinstance(fields, frozenset):
+            fields = frozenset(fields)
+        self.projection = fields
+        self.root = None
+        self.xml = None
+
+    @classmethod
+    def _get_descriptor(cls, field):
+        "Return the descriptor of the attribute, for a projection."
+        for klass in cls.__mro__:
+            descriptor = klass.__dict__.get(field)
+            if descriptor is not None: break
+        if not isinstance(descriptor, BaseDescriptor):
+            raise ValueError("cannot project field '%s'" % field)
+        return descriptor
+
+    def snapshot(self):
+        """Return a picklable snapshot of this instance, without the reference
+        to the Lims instance. The content is included only if loaded."""
+        xml = self.xml
+        if self.root is not None:
+            xml = ElementTree.tostring(self.root, encoding='UTF-8')
+        return Snapshot(self.__class__, self.id, xml, None)
+
     def put(self):
         assert self.uri
+        self.get()                      # In full, if projected.
         data = self.lims.tostring(ElementTree.ElementTree(self.root))
         self.lims.put(self.uri, data)
+        self.lims.invalidate_queries(self.__class__)
+        self.lims._loaded(self)
 
 
 class Lab(Entity):
@@ -483,6 +667,22 @@ class Researcher(Entity):
         return u"%s %s" % (self.first_name, self.last_name)
 
 
+class File(Entity):
+    "File attached to a project or an artifact; content obtained separately."
+
+    _URI = 'files'
+
+    attached_to       = StringDescriptor('attached-to')
+    content_location  = StringDescriptor('content-location')
+    original_location = StringDescriptor('original-location')
+    is_published      = StringDescriptor('is-published')
+
+    def download(self, path, mapped=False):
+        """Download the content of the file to the given path;
+        see Lims.download."""
+        return self.lims.download(self, path, mapped=mapped)
+
+
 class Project(Entity):
     "Project concerning a number of samples; associated with a researcher."
 
@@ -497,7 +697,7 @@ class Project(Entity):
     udf           = UdfDictionaryDescriptor()
     udt           = UdtDictionaryDescriptor()
     externalids   = ExternalidListDescriptor()
-    # files XXX
+    files         = EntityListDescriptor(nsmap('file:file'), File)
     # permissions XXX
 
 
@@ -505,6 +705,8 @@ class Sample(Entity):
     "Customer's sample to be analyzed; associated with a project."
 
     _URI = 'samples'
+    _BATCH = True
+    _PREFIX = 'smp'
 
     name           = StringDescriptor('name')
     date_received  = StringDescriptor('date-received')
@@ -517,6 +719,30 @@ class Sample(Entity):
     udt            = UdtDictionaryDescriptor()
     externalids    = ExternalidListDescriptor()
 
+    @classmethod
+    def new(cls, lims, name, project, container, well, udf=dict()):
+        """Return a new sample instance, not yet created on the server;
+        see Lims.create and Lims.create_batch.
+        project: The project instance.
+        container: The container instance to place the sample in.
+        well: The location in the container, e.g. 'A:1'.
+        udf: dictionary of UDF values.
+        """
+        instance = cls(lims)
+        instance.root = ElementTree.Element(nsmap('smp:samplecreation'))
+        node = ElementTree.SubElement(instance.root, 'name')
+        node.text = name
+        ElementTree.SubElement(instance.root, 'project',
+                               dict(uri=project.uri, limsid=project.id))
+        node = ElementTree.SubElement(instance.root, 'location')
+        ElementTree.SubElement(node, 'container',
+                               dict(uri=container.uri, limsid=container.id))
+        ElementTree.SubElement(node, 'value').text = well
+        udfs = instance.udf
+        for key, value in udf.iteritems():
+            udfs[key] = value
+        return instance
+
 
 class Containertype(Entity):
     "Type of container for analyte artifacts."
@@ -535,6 +761,8 @@ class Container(Entity):
     "Container for analyte artifacts."
 
     _URI = 'containers'
+    _BATCH = True
+    _PREFIX = 'con'
 
     name           = StringDescriptor('name')
     type           = EntityDescriptor('type', Containertype)
@@ -544,6 +772,18 @@ class Container(Entity):
     udt            = UdtDictionaryDescriptor()
     state          = StringDescriptor('state')
 
+    @classmethod
+    def new(cls, lims, name, type):
+        """Return a new container instance, not yet created on the server;
+        see Lims.create and Lims.create_batch.
+        type: The container type instance.
+        """
+        instance = cls(lims)
+        instance.root = ElementTree.Element(nsmap('con:container'))
+        ElementTree.SubElement(instance.root, 'name').text = name
+        ElementTree.SubElement(instance.root, 'type', dict(uri=type.uri))
+        return instance
+
     def get_placements(self):
         """Get the dictionary of locations and artifacts
         using the more efficient batch call."""
@@ -581,6 +821,7 @@ class Artifact(Entity):
     "Any process input or output; analyte or file."
 
     _URI = 'artifacts'
+    _BATCH = True
 
     state          = StateDescriptor()
     name           = StringDescriptor('name')
@@ -593,11 +834,38 @@ class Artifact(Entity):
     location       = LocationDescriptor('location')
     working_flag   = StringDescriptor('working-flag')
     samples        = EntityListDescriptor('sample', Sample)
-    # reagent_labels XXX
+    reagent_labels = ReagentLabelListDescriptor('reagent-label')
     # artifact_flags XXX
     udf              = UdfDictionaryDescriptor()
-    # files XXX
+    files            = EntityListDescriptor(nsmap('file:file'), File)
     # artifact_groups XXX
-    
+
+    def __init__(self, lims, id=None, state=None):
+        """state: Id of the historical state to get. An instance for a given
+        state is cached separately from the one for the current state."""
+        self.state_id = state
+        super(Artifact, self).__init__(lims, id=id)
+
+    @property
+    def key(self):
+        return self.get_key(self.id, self.state_id)
+
+    @classmethod
+    def get_key(cls, id, state=None):
+        key = super(Artifact, cls).get_key(id)
+        if state is not None:
+            key += u" state=%s" % state
+        return key
+
+    @property
+    def uri(self):
+        uri = super(Artifact, self).uri
+        if self.state_id is not None:
+            uri += "?state=%s" % self.state_id
+        return uri
+
+    def snapshot(self):
+        return super(Artifact, self).snapshot()._replace(state=self.state_id)
+
 
 Sample.artifact = EntityDescriptor('artifact', Artifact)
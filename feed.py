@@ -0,0 +1,138 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Change feed: poll for entities modified on the server.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import time
+import hashlib
+import threading
+import collections
+
+# A change of an entity instance detected by a ChangeFeed.
+# kind: 'new' if the instance was not seen before by the feed,
+#       otherwise 'modified'.
+# time: The time of the poll that detected the change.
+ChangeEvent = collections.namedtuple('ChangeEvent',
+                                     ['kind', 'klass', 'instance', 'time'])
+
+
+class ChangeFeed(object):
+    """Poll the server for instances of an entity class modified since
+    the previous poll, using the 'last_modified' filter of its get_*
+    method: Lab, Researcher, Project, Container, Process or Artifact.
+
+    The watermark of each poll is set back by 'overlap' seconds to allow
+    for clock differences and for modifications in progress during the
+    previous poll. Instances reported again in the overlap are detected
+    by their unchanged XML and not delivered twice.
+
+    The changed instances are loaded, replacing any stale content in
+    the Lims cache, before the events are delivered.
+    """
+
+    def __init__(self, lims, klass, since=None, interval=60.0, overlap=60.0,
+                 **filters):
+        """lims: The Lims instance.
+        klass: The entity class to watch.
+        since: Start time in seconds since the epoch; default now.
+        interval: Seconds between polls.
+        overlap: Seconds by which to set back the watermark in each poll.
+        filters: Further keyword arguments for the get_* method.
+        """
+        self.lims = lims
+        self.klass = klass
+        self.method = getattr(lims, "get_%s" % klass._URI)
+        if since is None:
+            since = time.time()
+        self.watermark = since
+        self.interval = interval
+        self.overlap = overlap
+        self.filters = filters
+        self.callbacks = []
+        self._seen = dict()             # key -> (digest, time)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def poll(self):
+        """Get the instances modified since the watermark, load them,
+        and return the list of events for those that actually changed.
+        The events are also delivered to the callbacks."""
+        now = time.time()
+        since = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                              time.gmtime(self.watermark - self.overlap))
+        instances = self.method(last_modified=since, **self.filters)
+        self.lims.load_batch(instances, force=True)
+        events = []
+        for instance in instances:
+            digest = hashlib.md5(instance.snapshot().xml).hexdigest()
+            previous = self._seen.get(instance.key)
+            self._seen[instance.key] = (digest, now)
+            if previous is None:
+                kind = 'new'
+            elif previous[0] != digest:
+                kind = 'modified'
+            else:
+                continue
+            events.append(ChangeEvent(kind, self.klass, instance, now))
+        self.watermark = now
+        self._prune(now)
+        for event in events:
+            for callback in self.callbacks:
+                callback(event)
+        return events
+
+    def _prune(self, now):
+        """Forget the instances that cannot be reported again unless
+        modified, i.e. those seen before the current overlap window.
+        Since a feed then no longer knows them, a later change of such
+        an instance is reported with kind 'new'."""
+        limit = now - self.overlap - self.interval
+        for key, (digest, seen) in self._seen.items():
+            if seen < limit:
+                del self._seen[key]
+
+    def subscribe(self, callback):
+        "Call the callback with each event, when delivered by poll."
+        self.callbacks.append(callback)
+
+    def events(self):
+        """Generate the events, polling every 'interval' seconds.
+        The generator never ends; the consumer should break out of it."""
+        while True:
+            start = time.time()
+            for event in self.poll():
+                yield event
+            delay = self.interval - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def start(self):
+        """Poll every 'interval' seconds in a background thread,
+        delivering the events to the callbacks. The requests are made
+        in the 'bulk' lane."""
+        self.stop()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Stop the background polling, if running."
+        if self._thread is None: return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        delay = 0
+        while not self._stop.wait(delay):
+            start = time.time()
+            try:
+                with self.lims.priority('bulk'):
+                    self.poll()
+            except Exception:           # Keep the watermark; retry.
+                pass
+            delay = max(0, self.interval - (time.time() - start))
@@ -0,0 +1,195 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+In-memory secondary indexes over the loaded entity instances.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import time
+import bisect
+import threading
+import urlparse
+
+from .entities import UDF_FIELD
+
+
+class Index(object):
+    """Indexes of loaded instances by name, project, container and
+    selected UDF values, maintained by the Lims instance as instances
+    are loaded. A query is answered only if the index is known to cover
+    all instances that could match it; see 'cover'. Instances whose XML
+    has not been parsed yet are indexed when the index is next queried.
+    """
+
+    def __init__(self, udfs=[], ttl=300.0):
+        """udfs: Names of the UDFs whose values to index.
+        ttl: Number of seconds for which a recorded coverage is trusted;
+             None trusts it until 'uncover' is called.
+        """
+        self.udfs = set(udfs)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._entries = dict()          # key -> (klass, id, values)
+        self._ids = dict()              # klass -> set of indexed ids
+        self._lookup = dict()           # (klass, field, value) -> set of ids
+        self._names = dict()            # klass -> sorted list of (name, id)
+        self._instances = dict()        # key -> instance
+        self._coverage = dict()         # (klass, field, value) -> (time, ids)
+        self._pending = dict()          # key -> instance with unparsed XML
+
+    def add(self, instance):
+        """Index the loaded instance, replacing any previous entry for it.
+        If its XML is not parsed yet, it is indexed when next queried."""
+        if instance.root is None:
+            with self.lock:
+                self._remove(instance.key)
+                self._pending[instance.key] = instance
+            return
+        values = self._get_values(instance)
+        klass = instance.__class__
+        with self.lock:
+            self._pending.pop(instance.key, None)
+            self._remove(instance.key)
+            self._entries[instance.key] = (klass, instance.id, values)
+            self._instances[instance.key] = instance
+            self._ids.setdefault(klass, set()).add(instance.id)
+            for field, value in values:
+                self._lookup.setdefault((klass, field, value),
+                                        set()).add(instance.id)
+                if field == 'name' and value is not None:
+                    bisect.insort(self._names.setdefault(klass, []),
+                                  (value, instance.id))
+
+    def _flush(self):
+        "Index the instances whose XML was not parsed when added."
+        with self.lock:
+            pending = self._pending.values()
+        for instance in pending:
+            if instance.root is not None:
+                self.add(instance)
+            elif instance.xml is not None:
+                instance.get()          # Parses the XML; indexes it.
+            else:                       # Projected since; cannot index.
+                with self.lock:
+                    self._pending.pop(instance.key, None)
+
+    def _remove(self, key):
+        try:
+            klass, id, values = self._entries.pop(key)
+        except KeyError:
+            return
+        del self._instances[key]
+        self._ids[klass].discard(id)
+        for field, value in values:
+            self._lookup[(klass, field, value)].discard(id)
+            if field == 'name' and value is not None:
+                names = self._names[klass]
+                del names[bisect.bisect_left(names, (value, id))]
+
+    def _get_values(self, instance):
+        "Return the list of (field, value) for the instance to index."
+        root = instance.root
+        result = []
+        node = root.find('name')
+        if node is not None:
+            result.append(('name', node.text))
+        elif 'name' in root.attrib:
+            result.append(('name', root.attrib['name']))
+        node = root.find('project')
+        if node is not None:
+            result.append(('project', self._get_id(node)))
+        node = root.find('location/container')
+        if node is not None:
+            result.append(('container', self._get_id(node)))
+        for node in root.findall(UDF_FIELD):
+            name = node.attrib['name']
+            if name in self.udfs:
+                result.append(("udf.%s" % name, node.text))
+        return result
+
+    def _get_id(self, node):
+        try:
+            return node.attrib['limsid']
+        except KeyError:
+            parts = urlparse.urlparse(node.attrib['uri'])
+            return parts.path.split('/')[-1]
+
+    def cover(self, klass, ids, field=None, value=None):
+        """Record that the given ids are all instances of the class,
+        or all those having the value for the field, if given."""
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+        with self.lock:
+            self._coverage[(klass, field, value)] = (expires, set(ids))
+
+    def uncover(self, klass):
+        """Forget the coverage recorded for the class, e.g. when instances
+        of it have been created."""
+        with self.lock:
+            for key in self._coverage.keys():
+                if key[0] is klass:
+                    del self._coverage[key]
+
+    def is_covered(self, klass, field=None, value=None):
+        """Are all instances of the class, or all those having the value
+        for the field, loaded and indexed?"""
+        self._flush()
+        with self.lock:
+            try:
+                expires, ids = self._coverage[(klass, field, value)]
+            except KeyError:
+                return False
+            if expires is not None and expires <= time.time():
+                del self._coverage[(klass, field, value)]
+                return False
+            return ids.issubset(self._ids.get(klass, ()))
+
+    def query(self, klass, name=None, name_prefix=None,
+              project=None, container=None, udf=dict()):
+        """Return the list of indexed instances of the class matching all
+        the given criteria, or None if the index does not cover the query.
+        name: Name, or list of names.
+        name_prefix: Beginning of the name.
+        project: LIMS id of the project.
+        container: LIMS id of the container.
+        udf: dictionary of indexed UDF names and values, as strings.
+        """
+        for key in udf:
+            if key not in self.udfs: return None
+        if not self.is_covered(klass):
+            if project is not None and \
+               self.is_covered(klass, 'project', project):
+                pass
+            elif container is not None and \
+                 self.is_covered(klass, 'container', container):
+                pass
+            else:
+                return None
+        with self.lock:
+            ids = set(self._ids.get(klass, ()))
+            if name is not None:
+                if isinstance(name, basestring):
+                    name = [name]
+                found = set()
+                for value in name:
+                    found.update(self._lookup.get((klass, 'name', value), ()))
+                ids.intersection_update(found)
+            if name_prefix is not None:
+                names = self._names.get(klass, [])
+                found = set()
+                pos = bisect.bisect_left(names, (name_prefix,))
+                while pos < len(names) and \
+                      names[pos][0].startswith(name_prefix):
+                    found.add(names[pos][1])
+                    pos += 1
+                ids.intersection_update(found)
+            criteria = [('project', project), ('container', container)]
+            criteria.extend([("udf.%s" % k, v) for k, v in udf.iteritems()])
+            for field, value in criteria:
+                if value is None: continue
+                ids.intersection_update(self._lookup.get((klass, field, value),
+                                                         ()))
+            return [self._instances[klass.get_key(id)] for id in sorted(ids)]
@@ -6,12 +6,43 @@ Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
 Copyright (C) 2012 Per Kraulis
 """
 
+import os
+import mmap
+import threading
+import time
+import urllib
+import multiprocessing
+import itertools
+import contextlib
+import collections
 from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 # http://docs.python-requests.org/
 import requests
 
 from .entities import *
+from .index import Index
+from .catalog import Catalog
+from .query import Query
+from .prefetch import Prefetcher
+
+
+# The instances of a project and its related entities, as loaded by
+# Lims.load_project_tree. Lists for the levels not loaded are empty.
+ProjectTree = collections.namedtuple('ProjectTree',
+                                     ['project', 'samples', 'artifacts',
+                                      'containers', 'containertypes'])
+
+# The operation to continue from where it stopped when its deadline
+# expired, as given by a Partial result; see Lims.resume.
+Resume = collections.namedtuple('Resume', ['method', 'args'])
+
+# The location of a sample's root artifact, as given by
+# Lims.get_sample_locations. Container and well are None if not placed.
+SampleLocation = collections.namedtuple('SampleLocation',
+                                        ['sample', 'artifact',
+                                         'container', 'well'])
 
 
 class Lims(object):
@@ -19,56 +50,292 @@ class Lims(object):
 
     VERSION = 'v1'
 
-    def __init__(self, baseuri, username, password):
+    # Longest URL for a list query; longer queries are split into several.
+    MAX_URL_LENGTH = 2000
+
+    # Largest number of instances in a batch call made by load_batch.
+    BATCH_SIZE = 500
+
+    # Number of bytes per read when downloading file content.
+    CHUNK_SIZE = 1024 * 1024
+
+    # The priority lanes of requests; see 'priority'.
+    LANES = ('interactive', 'bulk')
+
+    def __init__(self, baseuri, username, password,
+                 query_ttl=None, threads=4, lanes=dict(), timeout=None,
+                 parse_pool=None):
         """baseuri: Base URI for the GenoLogics server, excluding
                     the 'api' or version parts!
                     For example: https://genologics.scilifelab.se:8443/
         username: The account name of the user to login as.
         password: The password for the user account to login as.
+        query_ttl: Number of seconds to cache the result of a get_* list
+                   call for a given set of filters; None disables caching.
+        threads: Maximum number of concurrent requests made by one call.
+        lanes: Dictionary of priority lane, 'interactive' or 'bulk', to
+               the maximum number of concurrent requests in it, over all
+               threads; no limit for a lane not given. See 'priority'.
+        timeout: Number of seconds to wait for the server to respond to
+                 a request; None waits forever. See also 'deadline'.
+        parse_pool: Default multiprocessing.Pool in which to parse the
+                    responses of projected batch calls; see get_batch.
         """
         self.baseuri = baseuri.rstrip('/') + '/'
         self.username = username
         self.password = password
         self.cache = dict()
+        self.index = None
+        self.prefetcher = None
+        self.query_ttl = query_ttl
+        self.query_cache = dict()
+        self.threads = threads
+        self.catalog = None
+        self.timeout = timeout
+        self.parse_pool = parse_pool
+        # Guards the cache and the in-flight entity loads.
+        self.lock = threading.RLock()
+        self._flights = dict()
+        self._lanes = _Lanes(lanes)
+        self._local = threading.local()
 
     def uri(self, *segments):
         "Return the full URI given the path segments."
         segments = ['api', self.VERSION] + list(segments)
         return urlparse.urljoin(self.baseuri, '/'.join(segments))
 
-    def get(self, uri, params=dict()):
-        "Get from the given URI. Return the ElementTree parsed from the XML."
-        r = requests.get(uri, params=params,
-                         auth=(self.username, self.password),
-                         headers=dict(accept='application/xml'))
+    @contextlib.contextmanager
+    def priority(self, lane):
+        """Context manager making the requests in the block, including those
+        made for it in other threads, in the given priority lane:
+        'interactive' or 'bulk'. Each lane has its own concurrency limit;
+        see the 'lanes' argument of the constructor. By default, requests
+        for single instances and for the first page of a list are made in
+        the 'interactive' lane, and those for further pages, batch calls
+        and downloads of several files in the 'bulk' lane.
+        None keeps the lane of the enclosing block, if any.
+        """
+        if lane is None:
+            yield
+            return
+        if lane not in self.LANES:
+            raise ValueError("invalid priority lane '%s'" % lane)
+        previous = getattr(self._local, 'lane', None)
+        self._local.lane = lane
+        try:
+            yield
+        finally:
+            self._local.lane = previous
+
+    def _get_lane(self, default='interactive'):
+        "Return the lane set by 'priority' in this thread, or the default."
+        return getattr(self._local, 'lane', None) or default
+
+    def _enter_lane(self, priority=None):
+        """Return the context manager holding a place in the lane, by
+        default that of this thread, waiting at most until the deadline."""
+        return self._lanes.enter(priority or self._get_lane(),
+                                 getattr(self._local, 'deadline', None))
+
+    @contextlib.contextmanager
+    def deadline(self, seconds, partial=False):
+        """Context manager limiting the time of the operations in the block,
+        including the requests made for them in other threads, to the given
+        number of seconds. A request that would end after the deadline
+        raises DeadlineExceeded. An enclosing deadline still applies.
+        partial: Instead of raising DeadlineExceeded, the get_* list calls
+                 and load_batch return the results obtained so far, as a
+                 Partial list whose 'resume' token continues the operation;
+                 see 'resume'. The error is still raised by other calls.
+        """
+        previous = (getattr(self._local, 'deadline', None),
+                    getattr(self._local, 'partial', False))
+        deadline = time.time() + seconds
+        if previous[0] is not None:
+            deadline = min(deadline, previous[0])
+        self._local.deadline = deadline
+        self._local.partial = partial
+        try:
+            yield
+        finally:
+            self._local.deadline, self._local.partial = previous
+
+    def resume(self, token):
+        """Continue the operation that returned a Partial result, as given by
+        its 'resume' token, from where it stopped. Return the remaining
+        results; a Partial result again if the deadline, if any, expires.
+        """
+        try:
+            return getattr(self, token.method)(*token.args)
+        except DeadlineExceeded, error:
+            if error.result is None or \
+               not getattr(self._local, 'partial', False): raise
+            return error.result
+
+    def _get_timeout(self):
+        """Return the timeout for a request, given by 'timeout' and by the
+        deadline, if any. Raise DeadlineExceeded if it has expired."""
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return self.timeout
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('deadline exceeded')
+        if self.timeout is None:
+            return remaining
+        return min(self.timeout, remaining)
+
+    def _send(self, method, uri, **kwargs):
+        "Make the request using the 'requests' function, with the timeout."
+        timeout = self._get_timeout()
+        try:
+            return method(uri, auth=(self.username, self.password),
+                          timeout=timeout, **kwargs)
+        except requests.exceptions.Timeout:
+            deadline = getattr(self._local, 'deadline', None)
+            if deadline is not None and time.time() >= deadline:
+                raise DeadlineExceeded('deadline exceeded')
+            raise
+
+    def _in_context(self, function, lane=None):
+        """Return the function wrapped to make its requests in the lane,
+        by default that of this thread, and with the deadline of this
+        thread, when called in another thread."""
+        if lane is None:
+            lane = getattr(self._local, 'lane', None)
+        deadline = getattr(self._local, 'deadline', None)
+        partial = getattr(self._local, 'partial', False)
+        def call(*args):
+            previous = (getattr(self._local, 'deadline', None),
+                        getattr(self._local, 'partial', False))
+            self._local.deadline = deadline
+            self._local.partial = partial
+            try:
+                with self.priority(lane):
+                    return function(*args)
+            finally:
+                self._local.deadline, self._local.partial = previous
+        return call
+
+    def get(self, uri, params=dict(), priority=None):
+        """Get from the given URI. Return the ElementTree parsed from the XML.
+        priority: Lane of the request; default as given by 'priority'.
+        """
+        with self._enter_lane(priority):
+            r = self._send(requests.get, uri, params=params,
+                           headers=dict(accept='application/xml'))
         return self.parse_response(r)
 
-    def put(self, uri, data, params=dict()):
+    def put(self, uri, data, params=dict(), priority=None):
         """Put the serialized XML to the given URI.
         Return the ElementTree parsed from the response XML.
         """
-        r = requests.put(uri, data=data, params=params,
-                         auth=(self.username, self.password),
-                         headers={'content-type':'application/xml',
-                                  'accept': 'application/xml'})
+        with self._enter_lane(priority):
+            r = self._send(requests.put, uri, data=data, params=params,
+                           headers={'content-type':'application/xml',
+                                    'accept': 'application/xml'})
         return self.parse_response(r)
 
-    def post(self, uri, data, params=dict()):
+    def post(self, uri, data, params=dict(), priority=None, parse=True):
         """Post the serialized XML to the given URI.
         Return the ElementTree parsed from the response XML.
+        If parse is False, return the response XML content as is.
         """
-        r = requests.post(uri, data=data, params=params,
-                          auth=(self.username, self.password),
-                          headers={'content-type': 'application/xml',
-                                   'accept': 'application/xml'})
-        return self.parse_response(r)
+        with self._enter_lane(priority):
+            r = self._send(requests.post, uri, data=data, params=params,
+                           headers={'content-type': 'application/xml',
+                                    'accept': 'application/xml'})
+        if parse:
+            return self.parse_response(r)
+        if r.status_code != 200:
+            self.parse_response(r)      # Raises the HTTP error.
+        return r.content
+
+    def download(self, file, path, mapped=False, priority=None):
+        """Download the content of the file instance to the given path,
+        in chunks, without keeping it in memory. The content is written
+        to a temporary file 'path.part' which is renamed when complete.
+        If a temporary file exists from an interrupted download, only
+        the remaining content is requested, if the server allows;
+        also after DeadlineExceeded, which is checked for every chunk.
+        Return the path, or the content mapped if mapped; see map_file.
+        """
+        partial = path + '.part'
+        headers = dict()
+        if os.path.exists(partial):
+            headers['range'] = "bytes=%i-" % os.path.getsize(partial)
+        with self._enter_lane(priority):
+            r = self._send(requests.get,
+                           self.uri(File._URI, file.id, 'download'),
+                           headers=headers, stream=True)
+            try:
+                outfile = None
+                if r.status_code == 416 and 'range' in headers:
+                    # Nothing after the range start; complete only if the
+                    # size is given and is that of the temporary file,
+                    # otherwise start over.
+                    size = r.headers.get('content-range', '').split('/')[-1]
+                    if not (size.isdigit() and
+                            int(size) == os.path.getsize(partial)):
+                        os.remove(partial)
+                elif r.status_code == 206:
+                    outfile = open(partial, 'ab')
+                elif r.status_code == 200:
+                    outfile = open(partial, 'wb')
+                else:
+                    self.parse_response(r)  # Raises the HTTP error.
+                if outfile is not None:
+                    with outfile:
+                        for chunk in r.iter_content(self.CHUNK_SIZE):
+                            outfile.write(chunk)
+                            self._get_timeout()
+            finally:
+                r.close()
+        if not os.path.exists(partial):
+            return self.download(file, path, mapped=mapped, priority=priority)
+        os.rename(partial, path)
+        if mapped:
+            return self.map_file(path)
+        return path
+
+    def map_file(self, path):
+        """Return a read-only mmap of the file at the path, or an empty
+        string if the file is empty, which cannot be mapped. The map holds
+        a file descriptor until closed."""
+        with open(path, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return ''
+            return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def download_files(self, files, directory):
+        """Download the content of the file instances into the directory,
+        up to 'threads' at a time, each named by its LIMS id followed by
+        the extension of its original location. Files already downloaded
+        are not downloaded again. Return the list of paths. To map the
+        content, use map_file for each file when needed, and close it
+        when done, since every open map holds a file descriptor.
+        """
+        def get(file):
+            extension = os.path.splitext(file.original_location or '')[1]
+            path = os.path.join(directory, file.id + extension)
+            if not os.path.exists(path):
+                return self.download(file, path)
+            return path
+        lane = self._get_lane('bulk')
+        self.load_batch(files, priority=lane)
+        pool = ThreadPool(self.threads)
+        try:
+            return pool.map(self._in_context(get, lane), files)
+        finally:
+            pool.close()
 
     def check_version(self):
         """Raise ValueError if the version for this interface
         does not match any of the versions given for the API.
         """
         uri = urlparse.urljoin(self.baseuri, 'api')
-        r = requests.get(uri, auth=(self.username, self.password))
+        with self._enter_lane():
+            r = self._send(requests.get, uri)
         root = self.parse_response(r)
         tag = nsmap('ver:versions')
         assert tag == root.tag
@@ -93,7 +360,8 @@ class Lims(object):
         return root
 
     def get_labs(self, name=None, last_modified=None,
-                 udf=dict(), udtname=None, udt=dict(), start_index=None):
+                 udf=dict(), udtname=None, udt=dict(), start_index=None,
+                 parallel=False, mode='instances'):
         """Get a list of labs, filtered by keyword arguments.
         name: Lab name, or list of names.
         last_modified: Since the given ISO format datetime.
@@ -102,16 +370,22 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
         """
         params = self._get_params(name=name,
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Lab, params=params)
+        return self._get_instances(Lab, params=params,
+                                   parallel=parallel, mode=mode)
 
     def get_researchers(self, firstname=None, lastname=None, username=None,
                         last_modified=None,
-                        udf=dict(), udtname=None, udt=dict(),start_index=None):
+                        udf=dict(), udtname=None, udt=dict(),start_index=None,
+                        parallel=False, mode='instances'):
         """Get a list of researchers, filtered by keyword arguments.
         firstname: Researcher first name, or list of names.
         lastname: Researcher last name, or list of names.
@@ -122,6 +396,10 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
         """
         params = self._get_params(firstname=firstname,
                                   lastname=lastname,
@@ -129,10 +407,12 @@ class Lims(object):
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Researcher, params=params)
+        return self._get_instances(Researcher, params=params,
+                                   parallel=parallel, mode=mode)
 
     def get_projects(self, name=None, open_date=None, last_modified=None,
-                     udf=dict(), udtname=None, udt=dict(), start_index=None):
+                     udf=dict(), udtname=None, udt=dict(), start_index=None,
+                     parallel=False, mode='instances'):
         """Get a list of projects, filtered by keyword arguments.
         name: Project name, or list of names.
         open_date: Since the given ISO format date.
@@ -142,16 +422,22 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
         """
         params = self._get_params(name=name,
                                   open_date=open_date,
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Project, params=params)
+        return self._get_instances(Project, params=params,
+                                   parallel=parallel, mode=mode)
 
     def get_samples(self, name=None, projectname=None, projectlimsid=None,
-                    udf=dict(), udtname=None, udt=dict(), start_index=None):
+                    udf=dict(), udtname=None, udt=dict(), start_index=None,
+                    parallel=False, mode='instances'):
         """Get a list of samples, filtered by keyword arguments.
         name: Sample name, or list of names.
         projectlimsid: Samples for the project of the given LIMS id.
@@ -161,19 +447,26 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
         """
         params = self._get_params(name=name,
                                   projectname=projectname,
                                   projectlimsid=projectlimsid,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Sample, params=params)
+        return self._get_instances(Sample, params=params,
+                                   parallel=parallel, mode=mode)
 
     def get_artifacts(self, name=None, type=None, process_type=None,
                       artifact_flag_name=None, working_flag=None, qc_flag=None,
                       sample_name=None, artifactgroup=None, containername=None,
                       containerlimsid=None, reagent_label=None,
-                      udf=dict(), udtname=None, udt=dict(), start_index=None):
+                      last_modified=None,
+                      udf=dict(), udtname=None, udt=dict(), start_index=None,
+                      parallel=False, mode='instances'):
         """Get a list of artifacts, filtered by keyword arguments.
         name: Artifact name, or list of names.
         type: Artifact type, or list of types.
@@ -186,11 +479,16 @@ class Lims(object):
         containername: Residing in given container, by name, or list.
         containerlimsid: Residing in given container, by LIMS id, or list.
         reagent_label: having attached reagent labels.
+        last_modified: Since the given ISO format datetime.
         udf: dictionary of UDFs with 'UDFNAME[OPERATOR]' as keys.
         udtname: UDT name, or list of names.
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
         """
         params = self._get_params(name=name,
                                   type=type,
@@ -203,13 +501,31 @@ class Lims(object):
                                   containername=containername,
                                   containerlimsid=containerlimsid,
                                   reagent_label=reagent_label,
+                                  last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Artifact, params=params)
+        return self._get_instances(Artifact, params=params,
+                                   parallel=parallel, mode=mode)
+
+    def get_containertypes(self, name=None, start_index=None,
+                           parallel=False, mode='instances'):
+        """Get a list of container types, filtered by keyword arguments.
+        name: Container type name, or list of names.
+        start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
+        """
+        params = self._get_params(name=name,
+                                  start_index=start_index)
+        return self._get_instances(Containertype, params=params,
+                                   parallel=parallel, mode=mode)
 
     def get_containers(self, name=None, type=None,
                        state=None, last_modified=None,
-                       udf=dict(), udtname=None, udt=dict(), start_index=None):
+                       udf=dict(), udtname=None, udt=dict(), start_index=None,
+                       parallel=False, mode='instances'):
         """Get a list of containers, filtered by keyword arguments.
         name: Containers name, or list of names.
         type: Container type, or list of types.
@@ -220,6 +536,10 @@ class Lims(object):
         udt: dictionary of UDT UDFs with 'UDTNAME.UDFNAME[OPERATOR]' as keys
              and a string or list of strings as value.
         start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
         """
         params = self._get_params(name=name,
                                   type=type,
@@ -227,12 +547,14 @@ class Lims(object):
                                   last_modified=last_modified,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Container, params=params)
+        return self._get_instances(Container, params=params,
+                                   parallel=parallel, mode=mode)
 
     def get_processes(self, last_modified=None, type=None,
                       inputartifactslimsid=None,
                       techfirstname=None, techlastname=None, projectname=None,
-                      udf=dict(), udtname=None, udt=dict(), start_index=None):
+                      udf=dict(), udtname=None, udt=dict(), start_index=None,
+                      parallel=False, mode='instances'):
         """Get a list of processes, filtered by keyword arguments.
         last_modified: Since the given ISO format datetime.
         type: Process type, or list of types.
@@ -245,6 +567,10 @@ class Lims(object):
         techlastname: Last name of researcher, or list of.
         projectname: Name of project, or list of.
         start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
         """
         params = self._get_params(last_modified=last_modified,
                                   type=type,
@@ -254,7 +580,23 @@ class Lims(object):
                                   projectname=projectname,
                                   start_index=start_index)
         params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
-        return self._get_instances(Process, params=params)
+        return self._get_instances(Process, params=params,
+                                   parallel=parallel, mode=mode)
+
+    def get_processtypes(self, displayname=None, start_index=None,
+                         parallel=False, mode='instances'):
+        """Get a list of process types, filtered by keyword arguments.
+        displayname: Process type name, or list of names.
+        start_index: Page to retrieve; all if None.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        mode: 'instances' for a list of instances, 'ids' or 'uris' for
+              a generator of LIMS ids or URIs, or 'count' for the number
+              of matches; the latter without creating any instances.
+        """
+        params = self._get_params(displayname=displayname,
+                                  start_index=start_index)
+        return self._get_instances(Processtype, params=params,
+                                   parallel=parallel, mode=mode)
 
     def _get_params(self, **kwargs):
         "Convert keyword arguments to a kwargs dictionary."
@@ -275,48 +617,789 @@ class Lims(object):
             result["udt.%s" % key] = value
         return result
 
-    def _get_instances(self, klass, params=dict()):
+    def _get_instances(self, klass, params=dict(), parallel=False,
+                       mode='instances'):
+        if mode == 'count':
+            count = 0
+            for id in self._get_references(klass, params, parallel=parallel):
+                count += 1
+            return count
+        elif mode in ('ids', 'uris'):
+            return self._get_references(klass, params, parallel=parallel,
+                                        uris=mode == 'uris')
+        elif mode != 'instances':
+            raise ValueError("invalid mode '%s'" % mode)
+        try:
+            result = self._get_instances_cached(klass, params, parallel)
+        except DeadlineExceeded, error:
+            if error.result is None or \
+               not getattr(self._local, 'partial', False): raise
+            result = error.result
+        if self.prefetcher is not None:
+            self.prefetcher.register(result)
+        return result
+
+    def _get_instances_cached(self, klass, params, parallel):
+        if not self.query_ttl:
+            return self._get_instances_uncached(klass, params,
+                                                parallel=parallel)
+        key = (klass, self._get_params_key(params))
+        with self.lock:
+            try:
+                expires, result = self.query_cache[key]
+            except KeyError:
+                pass
+            else:
+                if expires > time.time():
+                    return list(result)
+        expires = time.time() + self.query_ttl
+        result = self._get_instances_uncached(klass, params, parallel=parallel)
+        with self.lock:
+            self._purge_queries()
+            self.query_cache[key] = (expires, result)
+        return list(result)
+
+    def _purge_queries(self):
+        """Discard the expired results of the get_* list calls, which
+        would otherwise accumulate for filters not used again, such as
+        a changing 'last_modified'. Call with the lock held."""
+        now = time.time()
+        for key, (expires, result) in self.query_cache.items():
+            if expires <= now:
+                del self.query_cache[key]
+
+    def _get_params_key(self, params):
+        "Return a hashable key for the params, independent of value order."
+        result = []
+        for key, value in params.iteritems():
+            if isinstance(value, (list, tuple, set)):
+                value = tuple(sorted(value))
+            result.append((key, value))
+        return tuple(sorted(result))
+
+    def invalidate_queries(self, klass=None):
+        """Discard the cached results of the get_* list calls for
+        the given entity class, or for all classes if None."""
+        with self.lock:
+            for key in self.query_cache.keys():
+                if klass is None or key[0] is klass:
+                    del self.query_cache[key]
+
+    def _get_instances_uncached(self, klass, params=dict(), parallel=False):
+        """Get the instances for the params, splitting the query into
+        several concurrent ones if its URL would be too long."""
+        uri = self.uri(klass._URI)
+        queries = self._split_params(uri, params)
+        if len(queries) == 1:
+            return self._get_instances_query(klass, params, parallel=parallel)
+        return self._get_instances_all(
+            [Resume('_get_instances_query', (klass, p, parallel, None))
+             for p in queries])
+
+    def _get_instances_all(self, tokens):
+        """Run the list queries given as resume tokens concurrently, and
+        return the instances from all, without duplicates. If the deadline
+        expires, raise DeadlineExceeded with the Partial result."""
+        def run(token):
+            try:
+                return getattr(self, token.method)(*token.args), None
+            except DeadlineExceeded, error:
+                if error.result is None: raise
+                return error.result, error.result.resume
+        pool = ThreadPool(min(self.threads, len(tokens)))
+        try:
+            results = pool.map(self._in_context(run), tokens)
+        finally:
+            pool.close()
+        result = []
+        found = set()
+        for instances, token in results:
+            for instance in instances:
+                if instance.id in found: continue
+                found.add(instance.id)
+                result.append(instance)
+        remaining = [token for instances, token in results if token]
+        if remaining:
+            raise DeadlineExceeded('deadline exceeded',
+                                   Partial(result, Resume('_get_instances_all',
+                                                          (remaining,))))
+        return result
+
+    def _get_url_length(self, uri, params):
+        "Return the length of the URL of the list query for the params."
+        lengths = []
+        for key, value in params.iteritems():
+            lengths.extend(self._get_param_lengths(key, value))
+        return len(uri) + 1 + sum(lengths) + max(len(lengths) - 1, 0)
+
+    def _get_param_lengths(self, key, value):
+        """Return the list of the lengths of the 'key=value' parts of the
+        query for the param, one for each value if a list. The values are
+        encoded as UTF-8 and quoted, as done by 'requests'."""
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        key = self._quote(key)
+        return [len(key) + 1 + len(self._quote(v))
+                for v in value if v is not None]
+
+    def _quote(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('UTF-8')
+        return urllib.quote_plus(str(value))
+
+    def _split_params(self, uri, params):
+        """Split the params into a list of params, each giving a URL
+        no longer than MAX_URL_LENGTH, by dividing up the values of the
+        multi-valued filters. Values of one filter are alternatives, so
+        the union of the results of the queries is the intended result."""
+        if self._get_url_length(uri, params) <= self.MAX_URL_LENGTH:
+            return [params]
+        lengths = []
+        for key, value in params.iteritems():
+            if isinstance(value, (list, tuple)) and len(value) > 1:
+                length = sum(self._get_param_lengths(key, value))
+                lengths.append((length, key))
+        if not lengths:
+            return [params]
+        key = max(lengths)[1]
+        rest = dict(params)
+        del rest[key]
+        available = self.MAX_URL_LENGTH - self._get_url_length(uri, rest)
+        chunks = [[]]
+        length = 0
+        for value in params[key]:
+            value_length = sum(self._get_param_lengths(key, value)) + 1
+            if chunks[-1] and length + value_length > available:
+                chunks.append([])
+                length = 0
+            chunks[-1].append(value)
+            length += value_length
+        result = []
+        for chunk in chunks:
+            query = dict(rest)
+            query[key] = chunk
+            result.extend(self._split_params(uri, query))
+        return result
+
+    def _get_instances_query(self, klass, params=dict(), parallel=False,
+                             uri=None):
+        """Get the instances from the pages of the list query, starting
+        at the page URI, if given. If the deadline expires, raise
+        DeadlineExceeded with the Partial result of the pages obtained."""
         result = []
         tag = klass._TAG
         if tag is None:
             tag = klass.__name__.lower()
-        root = self.get(self.uri(klass._URI), params=params)
-        while params.get('start-index') is None: # Loop over all pages.
-            for node in root.findall(tag):
-                try:
-                    id = node.attrib['limsid']
-                except KeyError:
-                    uri = node.attrib['uri']
-                    parts = urlparse.urlparse(uri)
-                    id = parts.path.split('/')[-1]
-                result.append(self._get_instance(klass, id))
+        next_uri = uri
+        try:
+            for root in self._get_pages(klass, params, parallel=parallel,
+                                        uri=uri):
+                for node in root.findall(tag):
+                    result.append(self._get_instance(klass,
+                                                     self._get_id(node)))
+                node = root.find('next-page')
+                if node is not None:
+                    next_uri = node.attrib['uri']
+        except DeadlineExceeded, error:
+            error.result = Partial(result,
+                                   Resume('_get_instances_query',
+                                          (klass, params, parallel, next_uri)))
+            raise
+        if params.get('start-index') is None and uri is None:
+            self._cover(klass, params, result)
+        return result
+
+    def _get_references(self, klass, params=dict(), parallel=False,
+                        uris=False):
+        """Generate the LIMS ids, or URIs, from the pages of the list query,
+        without creating any instances."""
+        tag = klass._TAG
+        if tag is None:
+            tag = klass.__name__.lower()
+        queries = self._split_params(self.uri(klass._URI), params)
+        found = set()
+        for query in queries:
+            for root in self._get_pages(klass, query, parallel=parallel):
+                for node in root.findall(tag):
+                    id = self._get_id(node)
+                    if len(queries) > 1: # Sub-queries may overlap.
+                        if id in found: continue
+                        found.add(id)
+                    if uris:
+                        yield node.attrib['uri']
+                    else:
+                        yield id
+
+    def _get_id(self, node):
+        "Return the LIMS id of the entity referenced by the XML node."
+        try:
+            return node.attrib['limsid']
+        except KeyError:
+            uri = node.attrib['uri']
+            parts = urlparse.urlparse(uri)
+            return parts.path.split('/')[-1]
+
+    def _get_pages(self, klass, params=dict(), parallel=False, uri=None):
+        """Generate the ElementTree of each page of the list query, in order.
+        Only one page if the params specify the start index.
+        parallel: Get the pages after the first concurrently.
+        uri: Start at this page URI, as given by the next-page link.
+        """
+        if uri is None:
+            root = self.get(self.uri(klass._URI), params=params)
+        else:
+            root = self.get(uri, params=self._get_params_missing(uri, params),
+                            priority=self._get_lane('bulk'))
+        yield root
+        if params.get('start-index') is not None: return
+        while True:
             node = root.find('next-page')
-            if node is None: break
-            root = self.get(node.attrib['uri'], params=params)
+            if node is None: return
+            previous, uri = uri, node.attrib['uri']
+            if parallel:
+                for root in self._get_pages_parallel(uri, params, previous):
+                    yield root
+                return
+            root = self.get(uri, params=self._get_params_missing(uri, params),
+                            priority=self._get_lane('bulk'))
+            yield root
+
+    def _get_pages_parallel(self, uri, params, previous=None):
+        """Generate the ElementTree of each page from the one at the given
+        next-page URI, in order. Its start index less that of the previous
+        page, at the given URI or by default the first, gives the page
+        size, so the following pages are requested concurrently, a number
+        at a time, until a page is the last one."""
+        first = self._get_start_index(uri)
+        if previous is None:
+            before = 0
+        else:
+            before = self._get_start_index(previous)
+        if first is None or before is None:
+            stride = 0
+        else:
+            stride = first - before
+        lane = self._get_lane('bulk')
+        if stride <= 0:                 # Unknown paging; go sequentially.
+            root = self.get(uri, params=self._get_params_missing(uri, params),
+                            priority=lane)
+            yield root
+            while root.find('next-page') is not None:
+                uri = root.find('next-page').attrib['uri']
+                root = self.get(uri,
+                                params=self._get_params_missing(uri, params),
+                                priority=lane)
+                yield root
+            return
+        get = lambda u: self.get(u, params=self._get_params_missing(u, params),
+                                 priority=lane)
+        pool = ThreadPool(self.threads)
+        try:
+            start = first
+            while True:
+                uris = [self._get_page_uri(uri, start + i * stride)
+                        for i in xrange(self.threads)]
+                for root in pool.map(self._in_context(get), uris):
+                    yield root
+                    if root.find('next-page') is None: return
+                start += self.threads * stride
+        finally:
+            pool.close()
+
+    def _get_start_index(self, uri):
+        "Return the start index in the page URI: 0 if none, None if invalid."
+        query = urlparse.parse_qs(urlparse.urlparse(uri).query)
+        try:
+            return int(query.get('start-index', ['0'])[0])
+        except (IndexError, ValueError):
+            return None
+
+    def _get_page_uri(self, uri, start_index):
+        "Return the page URI with the start index replaced."
+        parts = list(urlparse.urlparse(uri))
+        query = [(key, value) for key, value in urlparse.parse_qsl(parts[4])
+                 if key != 'start-index']
+        query.append(('start-index', str(start_index)))
+        parts[4] = urllib.urlencode(query)
+        return urlparse.urlunparse(parts)
+
+    def _get_params_missing(self, uri, params):
+        """Return the params not already given in the query of the URI,
+        such as the URI of the next page of a list."""
+        query = urlparse.parse_qs(urlparse.urlparse(uri).query)
+        result = dict()
+        for key, value in params.iteritems():
+            if key not in query:
+                result[key] = value
         return result
 
-    def get_batch(self, instances):
-        "Get the content of a set of instances using the efficient batch call."
+    def _cover(self, klass, params, instances):
+        """Record the coverage of the index, if any, given the complete
+        list of instances obtained for the params."""
+        if self.index is None: return
+        ids = [instance.id for instance in instances]
+        if not params:
+            self.index.cover(klass, ids)
+        elif params.keys() == ['projectlimsid'] and \
+             isinstance(params['projectlimsid'], basestring):
+            self.index.cover(klass, ids, 'project', params['projectlimsid'])
+        elif params.keys() == ['containerlimsid'] and \
+             isinstance(params['containerlimsid'], basestring):
+            self.index.cover(klass, ids,
+                             'container', params['containerlimsid'])
+
+    def enable_index(self, udfs=[], ttl=300.0):
+        """Maintain in-memory indexes of the loaded instances, for use by
+        query_index. Instances already loaded are indexed immediately.
+        udfs: Names of the UDFs whose values to index.
+        ttl: Number of seconds after which the instances obtained by a
+             get_* call no longer count as all those matching it;
+             None keeps them so until instances are created.
+        """
+        self.index = Index(udfs=udfs, ttl=ttl)
+        with self.lock:
+            instances = self.cache.values()
+        for instance in instances:
+            if instance.root is not None or instance.xml is not None:
+                self._loaded(instance)
+        return self.index
+
+    def enable_prefetch(self, threshold=0.5, min_count=3, max_entries=100000):
+        """Learn which attributes referencing other entities are followed
+        by reads of the referenced instances, and for those, prefetch the
+        referenced instances for the rest of the list an instance was
+        obtained in. See Prefetcher, which is set as the 'prefetcher'
+        attribute and returned; its 'stats' give the hit rate.
+        Set the attribute to None to disable prefetching.
+        """
+        self.prefetcher = Prefetcher(self, threshold=threshold,
+                                     min_count=min_count,
+                                     max_entries=max_entries)
+        return self.prefetcher
+
+    def query_index(self, klass, name=None, name_prefix=None,
+                    project=None, container=None, udf=dict()):
+        """Return the list of instances of the class matching the criteria,
+        using only the in-memory index; see Index.query. Return None if
+        there is no index, or it does not cover the query. An index covers
+        all instances of a class, or of a project or container, after the
+        instances of these have been obtained by a get_* call without any
+        other filter, and then loaded, e.g. by get_batch; until the 'ttl'
+        given to enable_index has passed since that call.
+        """
+        if self.index is None: return None
+        return self.index.query(klass, name=name, name_prefix=name_prefix,
+                                project=project, container=container, udf=udf)
+
+    def query(self, klass, where, udf=dict(), udtname=None, udt=dict(),
+              parallel=False, **kwargs):
+        """Return a Query for the instances of the class matching the
+        expression, obtained when iterated over; see query.py. The parts of
+        the expression that the server can evaluate are sent with the list
+        query, and the rest is evaluated on the instances, loaded in batches.
+        where: Expression made from query.Field and query.Udf.
+        udf, udtname, udt, kwargs: Other filters, as for the get_* method
+                                   of the class; e.g. projectlimsid.
+        parallel: Retrieve the pages concurrently, once the first is known.
+        """
+        params = self._get_params(**kwargs)
+        params.update(self._get_params_udf(udf=udf, udtname=udtname, udt=udt))
+        return Query(self, klass, where, params=params, parallel=parallel)
+
+    def _loaded(self, instance):
+        """Update the index and the catalog, if any, for the newly loaded
+        or saved instance. Historical states of artifacts are not indexed."""
+        if isinstance(instance, Artifact) and instance.state_id: return
+        if instance.root is None and instance.xml is None: return
+        if self.index is not None:
+            self.index.add(instance)
+        if self.catalog is not None:
+            self.catalog.loaded(instance)
+
+    def get_batch(self, instances, fields=None, priority=None, pool=None):
+        """Get the content of a set of instances using the efficient
+        batch call.
+        fields: List of attribute names, and 'udf:NAME' for UDF values, to
+                keep for each instance, discarding the XML; see
+                Entity.project_fields.
+        priority: Lane of the request; default 'bulk', unless otherwise
+                  given by 'priority'.
+        pool: multiprocessing.Pool in which to parse the response and
+              extract the values of the fields, if given; by default the
+              'parse_pool' of this instance. Not used without fields, nor
+              with the index, which needs the XML.
+        """
         if not instances:
             return []
+        priority = priority or self._get_lane('bulk')
+        if fields is not None:
+            fields = frozenset(fields)  # Shared by the projected instances.
+        if pool is None:
+            pool = self.parse_pool
         klass = instances[0].__class__
         root = ElementTree.Element(nsmap('ri:links'))
         for instance in instances:
             ElementTree.SubElement(root, 'link', dict(uri=instance.uri,
                                                       rel=klass._URI))
-        root = self.post(self.uri(klass._URI, 'batch/retrieve'),
-                         self.tostring(ElementTree.ElementTree(root)))
+        uri = self.uri(klass._URI, 'batch/retrieve')
+        data = self.tostring(ElementTree.ElementTree(root))
+        requested = dict([(i.key, i) for i in instances])
         result = []
+        if pool is not None and fields is not None and self.index is None:
+            content = self.post(uri, data, priority=priority, parse=False)
+            for id, state, values, references in \
+                    self._apply(pool, project_batch, (klass, content, fields)):
+                instance = self._get_batch_instance(klass, requested,
+                                                    id, state)
+                for field in references:
+                    values[field] = self._resolve(values[field])
+                instance.set_projection(fields, values)
+                result.append(instance)
+            return result
+        root = self.post(uri, data, priority=priority)
         for node in root.getchildren():
-            instance = self._get_instance(klass, node.attrib['limsid'])
+            instance = self._get_batch_instance(
+                klass, requested, node.attrib['limsid'],
+                _get_batch_state(klass, node.attrib.get('uri')))
             instance.root = node
+            instance.xml = None
+            instance.fields = None
+            instance.projection = None
+            self._loaded(instance)
+            if fields is not None:
+                instance.project_fields(fields)
             result.append(instance)
         return result
 
+    def _apply(self, pool, function, args):
+        """Return the result of the function called in the process pool,
+        waiting at most until the deadline, if any."""
+        deadline = getattr(self._local, 'deadline', None)
+        job = pool.apply_async(function, args)
+        if deadline is None:
+            return job.get()
+        try:
+            return job.get(max(deadline - time.time(), 0))
+        except multiprocessing.TimeoutError:
+            raise DeadlineExceeded('deadline exceeded')
+
+    def _resolve(self, value):
+        "Return the value with its references replaced by the instances."
+        if isinstance(value, _Reference):
+            return self._get_instance(value.klass, value.id)
+        elif isinstance(value, list):
+            return [self._resolve(v) for v in value]
+        elif isinstance(value, tuple):
+            return tuple([self._resolve(v) for v in value])
+        elif isinstance(value, dict):
+            return dict([(k, self._resolve(v)) for k, v in value.iteritems()])
+        return value
+
+    def _get_batch_instance(self, klass, requested, id, state):
+        """Return the requested instance for an instance in a batch response;
+        for artifacts, the one for the state given by _get_batch_state,
+        if requested, and otherwise the one for the current state."""
+        if state is not None:
+            try:
+                return requested[klass.get_key(id, state)]
+            except KeyError:
+                pass
+        return self._get_instance(klass, id)
+
+    def load_batch(self, instances, force=False, fields=None, priority=None):
+        """Load the content of the instances, unless already loaded or force,
+        using batch calls of at most BATCH_SIZE instances for the entity
+        classes that have them, and otherwise single requests. Up to
+        'threads' requests are made concurrently. Return the instances.
+        If the deadline expires, DeadlineExceeded is raised with the Partial
+        result of the instances loaded, or it is returned; see 'deadline'.
+        fields: Project the instances on these fields;
+                see Entity.project_fields.
+        priority: Lane of the requests; default 'bulk', unless otherwise
+                  given by 'priority'.
+        """
+        lane = priority or self._get_lane('bulk')
+        by_class = dict()
+        for instance in instances:
+            if force or not self._is_loaded(instance, fields):
+                by_class.setdefault(instance.__class__, []).append(instance)
+        tasks = []
+        for klass, unloaded in by_class.iteritems():
+            if klass._BATCH:
+                for pos in xrange(0, len(unloaded), self.BATCH_SIZE):
+                    chunk = unloaded[pos:pos+self.BATCH_SIZE]
+                    tasks.append((chunk, lambda chunk=chunk:
+                                  self.get_batch(chunk, fields=fields)))
+            else:
+                for instance in unloaded:
+                    tasks.append(([instance], lambda i=instance:
+                                  self._load_projected(i, force, fields)))
+        def run(task):
+            "Return the instances not loaded by the task."
+            try:
+                task[1]()
+            except DeadlineExceeded:
+                return task[0]
+            return []
+        run = self._in_context(run, lane)
+        if len(tasks) == 1:
+            results = [run(tasks[0])]
+        elif tasks:
+            pool = ThreadPool(min(self.threads, len(tasks)))
+            try:
+                results = pool.map(run, tasks)
+            finally:
+                pool.close()
+        else:
+            results = []
+        remaining = [i for result in results for i in result]
+        if not remaining:
+            return instances
+        skipped = set([id(i) for i in remaining])
+        result = Partial([i for i in instances if id(i) not in skipped],
+                         Resume('load_batch',
+                                (remaining, force, fields, priority)))
+        if not getattr(self._local, 'partial', False):
+            raise DeadlineExceeded('deadline exceeded', result)
+        return result
+
+    def _is_loaded(self, instance, fields=None):
+        """Is the content of the instance loaded; in full, or if fields are
+        given, at least projected on those fields?"""
+        if instance.root is not None or instance.xml is not None:
+            return True
+        if fields is None or instance.projection is None:
+            return False
+        return instance.projection.issuperset(fields)
+
+    def create(self, instance):
+        """Create the new instance, as made by e.g. Sample.new, on the server.
+        Its id and content are set from the response, and it is added
+        to the cache."""
+        klass = instance.__class__
+        data = self.tostring(ElementTree.ElementTree(instance.root))
+        root = self.post(self.uri(klass._URI), data)
+        instance.id = self._get_id(root)
+        instance.root = root
+        self._created(klass, [instance])
+        return instance
+
+    def create_batch(self, instances):
+        """Create the new instances, as made by e.g. Sample.new, on the
+        server using the batch create call, in chunks of at most BATCH_SIZE
+        instances of the same class. The instances may be given by any
+        iterable, which is consumed as the chunks are sent, up to 'threads'
+        chunks concurrently. The id of each instance is set from the
+        response, and it is added to the cache; its content is loaded
+        from the server when next accessed. Return the list of instances.
+        """
+        create = self._in_context(self._create_chunk, self._get_lane('bulk'))
+        chunks = self._get_chunks(instances)
+        pool = ThreadPool(self.threads)
+        try:
+            result = []
+            while True:
+                # Only as many chunks as are sent at a time are consumed;
+                # ThreadPool.imap would consume the whole iterable at once.
+                group = list(itertools.islice(chunks, self.threads))
+                if not group: break
+                for chunk in pool.map(create, group):
+                    result.extend(chunk)
+        finally:
+            pool.close()
+        return result
+
+    def _get_chunks(self, instances):
+        """Generate lists of at most BATCH_SIZE instances of the same class.
+        Raise ValueError for a class without the batch create call."""
+        chunk = []
+        for instance in instances:
+            if chunk and (len(chunk) >= self.BATCH_SIZE or
+                          instance.__class__ is not chunk[0].__class__):
+                yield chunk
+                chunk = []
+            if not chunk and instance.__class__._PREFIX is None:
+                raise ValueError("no batch create for class '%s'" %
+                                 instance.__class__.__name__)
+            chunk.append(instance)
+        if chunk:
+            yield chunk
+
+    def _create_chunk(self, instances):
+        klass = instances[0].__class__
+        root = ElementTree.Element(nsmap("%s:details" % klass._PREFIX))
+        for instance in instances:
+            root.append(instance.root)
+        root = self.post(self.uri(klass._URI, 'batch/create'),
+                         self.tostring(ElementTree.ElementTree(root)))
+        for instance, node in zip(instances, root.findall('link')):
+            instance.id = self._get_id(node)
+            instance.root = None
+        self._created(klass, instances)
+        return instances
+
+    def _created(self, klass, instances):
+        "Add the created instances to the cache, and update the queries."
+        with self.lock:
+            for instance in instances:
+                self.cache[instance.key] = instance
+        self.invalidate_queries(klass)
+        if self.index is not None:
+            self.index.uncover(klass)
+
+    def create_samples(self, rows, project):
+        """Create new samples in the project from the rows, using
+        create_batch. Return the list of sample instances.
+        rows: Iterable of dictionaries, such as a csv.DictReader, with the
+              sample 'name', the 'container' instance or LIMS id, and the
+              'well'. Other non-empty values are set as UDFs.
+        project: Project instance or LIMS id.
+        """
+        if isinstance(project, basestring):
+            project = self.get_project(project)
+        return self.create_batch(self._get_new_samples(rows, project))
+
+    def _get_new_samples(self, rows, project):
+        for row in rows:
+            row = dict(row)
+            name = row.pop('name')
+            container = row.pop('container')
+            if isinstance(container, basestring):
+                container = self.get_container(container)
+            well = row.pop('well')
+            udf = dict([(k, v) for k, v in row.iteritems() if v])
+            yield Sample.new(self, name, project, container, well, udf=udf)
+
+    def load_project_tree(self, project, depth=4):
+        """Load the project and, level by level down to the given depth,
+        its samples, their root artifacts, the containers of these, and
+        the container types, using batch and concurrent requests.
+        project: Project instance or LIMS id.
+        Return a ProjectTree of the loaded instances.
+        """
+        if isinstance(project, basestring):
+            project = self.get_project(project)
+        samples = []
+        artifacts = []
+        containers = []
+        containertypes = []
+        if depth >= 1:
+            samples = self.get_samples(projectlimsid=project.id, parallel=True)
+        self.load_batch([project] + samples)
+        if depth >= 2:
+            artifacts = self._unique([s.artifact for s in samples])
+            self.load_batch(artifacts)
+        if depth >= 3:
+            locations = [a.location for a in artifacts]
+            containers = self._unique([l[0] for l in locations if l])
+            self.load_batch(containers)
+        if depth >= 4:
+            containertypes = self._unique([c.type for c in containers])
+            self.load_batch(containertypes)
+        return ProjectTree(project, samples, artifacts,
+                           containers, containertypes)
+
+    def get_sample_locations(self, samples=[], names=None):
+        """Return a list of SampleLocation for the samples, giving the root
+        artifact of each, and the container and well it is placed in.
+        The samples, artifacts and containers are loaded in batch calls,
+        each container only once.
+        samples: List of Sample instances or LIMS ids.
+        names: Sample name, or list of names, of further samples.
+        """
+        samples = [isinstance(s, basestring) and self.get_sample(s) or s
+                   for s in samples]
+        if names is not None:
+            samples.extend(self.get_samples(name=names))
+        samples = self._unique(samples)
+        self.load_batch(samples)
+        artifacts = [sample.artifact for sample in samples]
+        self.load_batch(self._unique(artifacts))
+        locations = [artifact.location for artifact in artifacts]
+        self.load_batch(self._unique([l[0] for l in locations if l]))
+        result = []
+        for sample, artifact, location in zip(samples, artifacts, locations):
+            container, well = location or (None, None)
+            result.append(SampleLocation(sample, artifact, container, well))
+        return result
+
+    def get_reagent_label_index(self, pools):
+        """Return a dictionary with each pooled artifact as key, and as value
+        a dictionary of its reagent labels, each giving the tuple (sample,
+        artifact) for the labelled artifact of a sample in the pool.
+        The pools, samples and labelled artifacts are loaded in batch calls.
+        pools: Pooled artifact, list of them, or a container instance,
+               e.g. a flowcell, whose placed artifacts are the pools.
+        """
+        if isinstance(pools, Container):
+            pools = pools.placements.values()
+        elif isinstance(pools, Artifact):
+            pools = [pools]
+        pools = self._unique(pools)
+        self.load_batch(pools)
+        samples = self._unique([s for pool in pools for s in pool.samples])
+        self.load_batch(samples)
+        labels = set([l for pool in pools for l in pool.reagent_labels])
+        # The labelled artifacts are those with a single sample and label.
+        found = dict()
+        candidates = [pool for pool in pools if len(pool.samples) == 1]
+        if labels and samples:
+            artifacts = self.get_artifacts(
+                sample_name=sorted(set([s.name for s in samples])),
+                reagent_label=sorted(labels))
+            self.load_batch(artifacts)
+            candidates.extend(artifacts)
+        for artifact in candidates:
+            if len(artifact.samples) != 1: continue
+            if len(artifact.reagent_labels) != 1: continue
+            key = (artifact.samples[0].key, artifact.reagent_labels[0])
+            found.setdefault(key, artifact)
+        result = dict()
+        for pool in pools:
+            index = result[pool] = dict()
+            for sample in pool.samples:
+                for label in pool.reagent_labels:
+                    artifact = found.get((sample.key, label))
+                    if artifact is not None:
+                        index[label] = (sample, artifact)
+        return result
+
+    def _unique(self, instances):
+        "Return the list of instances without duplicates, in order."
+        result = []
+        found = set()
+        for instance in instances:
+            if instance.key in found: continue
+            found.add(instance.key)
+            result.append(instance)
+        return result
+
+    def load_catalog(self, refresh=None):
+        """Load all container types, process types, labs and researchers
+        into a Catalog, set as the 'catalog' attribute, and return it.
+        refresh: Reload the catalog every this many seconds in the background.
+        """
+        if self.catalog is not None:
+            self.catalog.stop()
+        self.catalog = Catalog(self)
+        self.catalog.load(force=False)
+        if refresh:
+            self.catalog.start(refresh)
+        return self.catalog
+
+    def _load_projected(self, instance, force=False, fields=None):
+        instance.get(force=force)
+        if fields is not None:
+            instance.project_fields(fields)
+
     def get_lab(self, id):
         "Get the lab instance having the given numeric id."
         return self._get_instance(Lab, id)
 
+    def get_researcher(self, id):
+        "Get the researcher instance having the given numeric id."
+        return self._get_instance(Researcher, id)
+
     def get_project(self, id):
         "Get the project instance having the given LIMS id."
         return self._get_instance(Project, id)
@@ -326,12 +1409,28 @@ class Lims(object):
         return self._get_instance(Sample, id)
 
     def get_artifact(self, id, state=None):
-        "Get the artifact instance having the given LIMS id."
-        artifact = self._get_instance(Artifact, id)
-        if state is not None:
-            if artifact.state != state:
-                artifact.state = state
-        return artifact
+        """Get the artifact instance having the given LIMS id.
+        state: Id of a historical state; its instance is distinct from,
+               and cached separately from, the one for the current state.
+        """
+        return self._get_instance(Artifact, id, state=state)
+
+    def get_artifact_states(self, artifacts, state):
+        """Get the given historical state of each of the artifacts, loaded
+        using batch calls. Return the list of state instances, in order.
+        artifacts: List of Artifact instances or LIMS ids.
+        state: Id of the state, or dictionary of LIMS id to state id.
+        """
+        result = []
+        for artifact in artifacts:
+            if isinstance(artifact, Artifact):
+                artifact = artifact.id
+            if isinstance(state, dict):
+                result.append(self.get_artifact(artifact, state[artifact]))
+            else:
+                result.append(self.get_artifact(artifact, state))
+        self.load_batch(result)
+        return result
 
     def get_containertype(self, id):
         "Get the container type instance having the given LIMS id."
@@ -341,15 +1440,92 @@ class Lims(object):
         "Get the container instance having the given LIMS id."
         return self._get_instance(Container, id)
 
+    def get_processtype(self, id):
+        "Get the process type instance having the given numeric id."
+        return self._get_instance(Processtype, id)
+
+    def get_file(self, id):
+        "Get the file instance having the given LIMS id."
+        return self._get_instance(File, id)
+
     def get_process(self, id):
         "Get the process instance having the given LIMS id."
         return self._get_instance(Process, id)
 
-    def _get_instance(self, klass, id):
+    def _get_instance(self, klass, id, state=None):
+        with self.lock:
+            if state is None:
+                try:
+                    return self.cache[klass.get_key(id)]
+                except KeyError:
+                    return klass(self, id)
+            try:
+                return self.cache[klass.get_key(id, state)]
+            except KeyError:
+                return klass(self, id, state=state)
+
+    def restore(self, snapshot, force=False):
+        """Get the instance for the snapshot made by Entity.snapshot,
+        with its content taken from the snapshot instead of the server.
+        The content of an already loaded instance is replaced only if force.
+        """
+        instance = self._get_instance(snapshot.klass, snapshot.id,
+                                      state=snapshot.state)
+        if snapshot.xml is not None:
+            if force or (instance.root is None and instance.xml is None):
+                instance.xml = snapshot.xml
+                instance.root = None
+                instance.fields = None
+                instance.projection = None
+                self._loaded(instance)
+        return instance
+
+    def snapshot_cache(self):
+        "Return a list of picklable snapshots of all cached instances."
+        with self.lock:
+            instances = self.cache.values()
+        return [instance.snapshot() for instance in instances]
+
+    def restore_cache(self, snapshots, force=False):
+        """Restore the snapshots, as made by snapshot_cache, into the cache.
+        Return the list of instances."""
+        return [self.restore(snapshot, force=force) for snapshot in snapshots]
+
+    def load(self, instance, force=False):
+        """Load the XML for the instance from the server, unless already done.
+        Concurrent callers for the same instance share one in-flight request.
+        If that request stops at the deadline or timeout of its caller, the
+        other callers retry it instead.
+        """
+        key = instance.key
+        while True:
+            with self.lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    if not force and instance.root is not None: return
+                    flight = self._flights[key] = _Flight()
+                    break
+            if flight.wait(): return
         try:
-            return self.cache[klass.get_key(id)]
-        except KeyError:
-            return klass(self, id)
+            if not force and instance.xml is not None:
+                instance.root = ElementTree.fromstring(instance.xml)
+            else:
+                instance.root = self.get(instance.uri)
+            instance.xml = None
+            instance.fields = None
+            instance.projection = None
+            instance.parse()
+        except (DeadlineExceeded, requests.exceptions.Timeout):
+            flight.abandoned = True     # Not an error for the others.
+            raise
+        except Exception, error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self._flights[key]
+            flight.done.set()
+        self._loaded(instance)
 
     def tostring(self, etree):
         "Return the ElementTree contents as a UTF-8 encoded XML string."
@@ -360,3 +1536,129 @@ class Lims(object):
     def write(self, outfile, etree):
         "Write the ElementTree contents as UTF-8 encoded XML to the open file."
         etree.write(outfile, encoding='UTF-8')
+
+
+def _get_batch_state(klass, uri):
+    "Return the artifact state given in the URI from a batch response."
+    if uri is None or klass is not Artifact: return None
+    state = urlparse.parse_qs(urlparse.urlparse(uri).query).get('state')
+    return state and state[0] or None
+
+
+def project_batch(klass, content, fields):
+    """Parse the XML content of a batch response, and return for each
+    instance in it the tuple (LIMS id, state, values, references): its
+    artifact state as given by _get_batch_state, the values of the fields
+    as given by Entity.get_projection, and the names of the fields whose
+    values contain _Reference tuples for the entities referenced.
+    Intended to be run in a worker process; the result is picklable,
+    and much smaller than the XML.
+    """
+    lims = _Detached()
+    result = []
+    for node in ElementTree.fromstring(content).getchildren():
+        id = node.attrib['limsid']
+        instance = klass(lims, id)
+        instance.root = node
+        values = instance.get_projection(fields)
+        references = [field for field, value in values.iteritems()
+                      if _has_reference(value)]
+        result.append((id, _get_batch_state(klass, node.attrib.get('uri')),
+                       values, references))
+    return result
+
+
+# An entity referenced by a value obtained in a worker process.
+_Reference = collections.namedtuple('_Reference', ['klass', 'id'])
+
+
+def _has_reference(value):
+    "Does the value obtained in a worker process contain a _Reference?"
+    if isinstance(value, _Reference):
+        return True
+    elif isinstance(value, (list, tuple)):
+        return any([_has_reference(v) for v in value])
+    elif isinstance(value, dict):
+        return any([_has_reference(v) for v in value.itervalues()])
+    return False
+
+
+class _Detached(object):
+    """In place of the Lims instance for the instances in a worker process;
+    the entities they reference are given as _Reference tuples."""
+
+    prefetcher = None
+
+    def __init__(self):
+        self.cache = dict()
+
+    def _get_instance(self, klass, id, state=None):
+        return _Reference(klass, id)
+
+
+class _Flight(object):
+    "A request in progress, which other threads may wait for."
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.abandoned = False
+
+    def wait(self):
+        """Wait for the request to finish; raise its error, if any.
+        Return False if it was abandoned, to be retried by the caller."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return not self.abandoned
+
+
+class _Lanes(object):
+    "The concurrency limits of the priority lanes of a Lims instance."
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.active = dict()
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def enter(self, lane, deadline=None):
+        """Context manager holding a place in the lane, once one is free.
+        Raise DeadlineExceeded if none is before the deadline, if given."""
+        limit = self.limits.get(lane)
+        with self.condition:
+            while limit is not None and self.active.get(lane, 0) >= limit:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceeded('deadline exceeded')
+                self.condition.wait(remaining)
+            self.active[lane] = self.active.get(lane, 0) + 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active[lane] -= 1
+                self.condition.notify_all()
+
+
+class DeadlineExceeded(Exception):
+    """The deadline of an operation expired; see Lims.deadline.
+    result: The Partial result obtained so far, if the operation has one.
+    """
+
+    def __init__(self, message, result=None):
+        super(DeadlineExceeded, self).__init__(message)
+        self.result = result
+
+
+class Partial(list):
+    """The results of an operation obtained before its deadline expired.
+    resume: Token for Lims.resume to continue the operation.
+    """
+
+    def __init__(self, items, resume):
+        super(Partial, self).__init__(items)
+        self.resume = resume
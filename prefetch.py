@@ -0,0 +1,214 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Speculative prefetching of related entities, learned from the order
+in which a script reads the attributes of the instances.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import threading
+import collections
+
+from .entities import Entity
+
+
+class Prefetcher(object):
+    """Learns, for each entity class and attribute referencing other
+    entities, such as Sample.artifact or Artifact.location, how often the
+    referenced instances are then read in turn. Once that is the case for
+    at least 'threshold' of at least 'min_count' reads of the attribute,
+    reading it on an instance from a list, as returned by a get_* call or
+    a list attribute, loads the list instances not yet loaded and the
+    instances referenced by them, using batch calls where available.
+    At most 'max_entries' instances are remembered for each purpose;
+    the oldest are forgotten.
+
+    Maintained by the Lims instance; see Lims.enable_prefetch.
+    """
+
+    def __init__(self, lims, threshold=0.5, min_count=3, max_entries=100000):
+        """threshold: Fraction of reads of an attribute followed by reads
+                      of the referenced instances for it to be prefetched.
+        min_count: Number of reads of an attribute before deciding.
+        max_entries: Number of instances to remember the lists, reads and
+                     prefetching of.
+        """
+        self.lims = lims
+        self.threshold = threshold
+        self.min_count = min_count
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        # key -> (instances, patterns done)
+        self._groups = collections.OrderedDict()
+        self._reads = dict()            # pattern -> number of reads
+        self._follows = dict()          # pattern -> number of follow-ups
+        # key -> pattern of the read
+        self._pending = collections.OrderedDict()
+        # key -> index of operation
+        self._prefetched = collections.OrderedDict()
+        # index -> [number of requests, hits, instances awaited]
+        self._operations = dict()
+        self._finished = [0, 0]         # Requests, wasted, of the others.
+        self._count = 0                 # Number of operations.
+        self.prefetched = 0             # Number of instances prefetched.
+        self.hits = 0                   # Number of those read afterwards.
+
+    def register(self, instances):
+        "Record that the instances were obtained together, as a list."
+        if len(instances) < 2: return
+        group = (list(instances), set())
+        with self.lock:
+            for instance in instances:
+                self._groups.pop(instance.key, None)
+                self._groups[instance.key] = group
+            while len(self._groups) > self.max_entries:
+                key, oldest = self._groups.popitem(last=False)
+                for instance in oldest[0]:
+                    if self._groups.get(instance.key) is oldest:
+                        del self._groups[instance.key]
+
+    def used(self, instance):
+        "Record that an attribute of the instance is being read."
+        if getattr(self._local, 'busy', False): return
+        key = instance.key
+        with self.lock:
+            pattern = self._pending.pop(key, None)
+            if pattern is not None:
+                self._follows[pattern] = self._follows.get(pattern, 0) + 1
+            operation = self._prefetched.pop(key, None)
+            if operation is not None:
+                self.hits += 1
+                self._operations[operation][1] += 1
+                self._release(operation)
+
+    def accessed(self, instance, descriptor, value):
+        """Record that the attribute given by the descriptor was read on
+        the instance, giving the value, and prefetch for the rest of its
+        list if the attribute has been learned to be followed up."""
+        if getattr(self._local, 'busy', False): return
+        targets = self._get_targets(value)
+        if not targets: return
+        if isinstance(value, list):
+            self.register(targets)
+        pattern = (instance.__class__, descriptor)
+        with self.lock:
+            self._reads[pattern] = self._reads.get(pattern, 0) + 1
+            for target in targets:
+                if target.key not in self._pending:
+                    self._pending[target.key] = pattern
+            while len(self._pending) > self.max_entries:
+                self._pending.popitem(last=False)
+            group = self._groups.get(instance.key)
+            if group is None or not self._is_learned(pattern): return
+            instances, done = group
+            if pattern in done: return
+            done.add(pattern)
+        self._local.busy = True
+        try:
+            self._prefetch(instances, descriptor)
+        except Exception:               # Speculative; the read will retry.
+            pass
+        finally:
+            self._local.busy = False
+
+    def _is_learned(self, pattern):
+        reads = self._reads.get(pattern, 0)
+        if reads < self.min_count: return False
+        return self._follows.get(pattern, 0) >= self.threshold * reads
+
+    def _get_targets(self, value):
+        "Return the list of entity instances in the value of an attribute."
+        if isinstance(value, Entity):
+            return [value]
+        elif isinstance(value, (list, tuple)):
+            return [v for v in value if isinstance(v, Entity)]
+        return []
+
+    def _prefetch(self, instances, descriptor):
+        "Load the instances, and those referenced by the attribute of each."
+        self._load(instances)
+        targets = []
+        found = set()
+        for instance in instances:
+            value = descriptor.__get__(instance, instance.__class__)
+            for target in self._get_targets(value):
+                if target.key in found: continue
+                found.add(target.key)
+                targets.append(target)
+        self._load(targets)
+
+    def _load(self, instances):
+        unloaded = [i for i in instances
+                    if i.root is None and i.xml is None and i.fields is None]
+        if not unloaded: return
+        requests = 0
+        by_class = dict()
+        for instance in unloaded:
+            by_class[instance.__class__] = \
+                by_class.get(instance.__class__, 0) + 1
+        for klass, count in by_class.iteritems():
+            if klass._BATCH:
+                requests += (count - 1) // self.lims.BATCH_SIZE + 1
+            else:
+                requests += count
+        with self.lock:
+            operation = self._count
+            self._count += 1
+            self._operations[operation] = [requests, 0, len(unloaded)]
+            for instance in unloaded:
+                previous = self._prefetched.pop(instance.key, None)
+                if previous is not None:
+                    self._release(previous)
+                self._prefetched[instance.key] = operation
+            while len(self._prefetched) > self.max_entries:
+                key, previous = self._prefetched.popitem(last=False)
+                self._release(previous)
+            self.prefetched += len(unloaded)
+        self.lims.load_batch(unloaded)
+
+    def _release(self, operation):
+        """Record that an instance prefetched by the operation is no longer
+        awaited; once none is, add its requests to the totals and forget it.
+        Call with the lock held."""
+        entry = self._operations[operation]
+        entry[2] -= 1
+        if entry[2] > 0: return
+        del self._operations[operation]
+        self._finished[0] += entry[0]
+        if not entry[1]:
+            self._finished[1] += entry[0]
+
+    def _get_name(self, klass, descriptor):
+        for cls in klass.__mro__:
+            for name, value in cls.__dict__.iteritems():
+                if value is descriptor: return name
+        return '?'
+
+    def stats(self):
+        """Return a dictionary of the counts of instances prefetched, hits
+        (those read afterwards), wasted (those not read so far), requests
+        made to prefetch, wasted requests (those for which no instance has
+        been read so far), the hit rate, and for each attribute 'Class.name'
+        the numbers of reads and of follow-up reads of its references."""
+        with self.lock:
+            requests, wasted = self._finished
+            for count, hits, awaited in self._operations.itervalues():
+                requests += count
+                if not hits:
+                    wasted += count
+            patterns = dict()
+            for pattern, reads in self._reads.iteritems():
+                klass, descriptor = pattern
+                name = "%s.%s" % (klass.__name__,
+                                  self._get_name(klass, descriptor))
+                patterns[name] = (reads, self._follows.get(pattern, 0))
+            return dict(prefetched=self.prefetched,
+                        hits=self.hits,
+                        wasted=self.prefetched - self.hits,
+                        requests=requests,
+                        wasted_requests=wasted,
+                        hit_rate=float(self.hits) / self.prefetched
+                                 if self.prefetched else None,
+                        patterns=patterns)
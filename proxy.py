@@ -0,0 +1,323 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Local caching proxy between Lims instances and the GenoLogics server,
+to be shared by many short-lived scripts. It keeps the connections to
+the server open, caches the responses of reads for a limited time, and
+makes only one request to the server for identical concurrent reads.
+Writes are passed through, and discard the cached responses they may
+have made stale. The URIs in the responses refer to the proxy.
+
+Usage: python -m genologics.proxy --baseuri https://lims.example.com:8443/
+
+The scripts then use the proxy as the server:
+
+    lims = Lims('http://localhost:8800/', USERNAME, PASSWORD)
+
+Responses are cached separately for each set of credentials.
+The counts of cache hits and misses are served at /proxy/stats.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
+
+import requests
+import requests.adapters
+
+# The request headers passed on to the server.
+HEADERS = ('authorization', 'accept', 'content-type', 'range')
+
+# The response headers passed on to the client, in addition to the length.
+RESPONSE_HEADERS = ('content-type', 'content-range', 'content-disposition')
+
+ERROR = """<exc:exception xmlns:exc="http://genologics.com/ri/exception">\
+<message>proxy: %s</message></exc:exception>"""
+
+
+class Proxy(object):
+    """Caching proxy for the GenoLogics server at 'baseuri', listening on
+    the given port of localhost, or on the address given by 'host'.
+    Reads are GET requests, except file downloads, and batch retrieve
+    calls; their responses are cached for 'ttl' seconds, at most
+    'max_entries' of them. A PUT or DELETE discards the responses for
+    the same kind of entity, and any other POST all responses.
+    """
+
+    def __init__(self, baseuri, port=8800, host='localhost', ttl=60.0,
+                 max_entries=10000, connections=16, timeout=None):
+        """connections: Number of connections to keep open to the server.
+        timeout: Seconds to wait for the server; None waits forever.
+        """
+        self.upstream = baseuri.rstrip('/') + '/'
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict() # key -> (expires, response)
+        self._flights = dict()
+        self._generations = dict()      # prefix, None for all -> writes
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0              # Reads answered by another's request.
+        self.writes = 0
+        self.server = _Server((host, port), _Handler)
+        self.server.proxy = self
+        self.baseuri = "http://%s:%i/" % (host, self.server.server_address[1])
+        self._thread = None
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        "Serve in a background thread."
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        "Return a dictionary of the counts of requests and cache entries."
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        coalesced=self.coalesced, writes=self.writes,
+                        entries=len(self.cache))
+
+    def handle(self, handler, method):
+        "Handle the request received by the handler."
+        path = handler.path
+        if method == 'GET' and path == '/proxy/stats':
+            handler.respond(200, [('content-type', 'application/json')],
+                            json.dumps(self.stats()))
+            return
+        local = "http://%s/" % handler.headers.get('host', '')
+        length = int(handler.headers.get('content-length') or 0)
+        data = length and handler.rfile.read(length) or None
+        if data is not None:
+            data = data.replace(local, self.upstream)
+        headers = dict()
+        for name in HEADERS:
+            if name in handler.headers:
+                headers[name] = handler.headers[name]
+        if (method == 'GET' and not path.endswith('/download')) or \
+           (method == 'POST' and path.endswith('/batch/retrieve')):
+            key = (method, path, headers.get('authorization'),
+                   headers.get('accept'), data)
+            status, response_headers, content = \
+                self.read(key, method, path, headers, data)
+        elif method == 'GET':
+            self.download(handler, path, headers, local)
+            return
+        else:
+            status, response_headers, content = \
+                self.forward(method, path, headers, data)
+            self.invalidate(method, path)
+        handler.respond(status, response_headers,
+                        content.replace(self.upstream, local))
+
+    def read(self, key, method, path, headers, data):
+        """Return the response for the read from the cache, if there,
+        otherwise from the server, or from a concurrent request for it.
+        The response is not cached if a write may have made it stale
+        while it was requested."""
+        with self.lock:
+            try:
+                expires, response = self.cache[key]
+            except KeyError:
+                pass
+            else:
+                if expires > time.time():
+                    self.hits += 1
+                    return response
+                del self.cache[key]
+            flight = self._flights.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self._flights[key] = _Flight()
+                flight.generation = self._get_generation(path)
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            return flight.wait()
+        try:
+            response = self.forward(method, path, headers, data)
+            with self.lock:
+                if response[0] == 200 and \
+                   flight.generation == self._get_generation(path):
+                    self.cache[key] = (time.time() + self.ttl, response)
+                    while len(self.cache) > self.max_entries:
+                        self.cache.popitem(last=False)
+            flight.response = response
+            return response
+        finally:
+            with self.lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    def _get_prefix(self, path):
+        "Return the path prefix for the kind of entity: /api/v1/KIND"
+        parts = path.split('?')[0].strip('/').split('/')
+        return '/' + '/'.join(parts[:3])
+
+    def _get_generation(self, path):
+        """Return the numbers of writes so far that may have changed the
+        response for the path. Call with the lock held."""
+        return (self._generations.get(None, 0),
+                self._generations.get(self._get_prefix(path), 0))
+
+    def forward(self, method, path, headers, data):
+        """Make the request to the server. Return the tuple
+        (status, headers, content)."""
+        try:
+            r = self.session.request(method, self.upstream + path.lstrip('/'),
+                                     headers=headers, data=data,
+                                     timeout=self.timeout)
+        except requests.exceptions.RequestException, error:
+            return (502, [('content-type', 'application/xml')],
+                    ERROR % error)
+        response_headers = [(name, r.headers[name])
+                            for name in RESPONSE_HEADERS if name in r.headers]
+        return (r.status_code, response_headers, r.content)
+
+    def download(self, handler, path, headers, local):
+        "Pass the file content from the server through in chunks."
+        try:
+            r = self.session.get(self.upstream + path.lstrip('/'),
+                                 headers=headers, stream=True,
+                                 timeout=self.timeout)
+        except requests.exceptions.RequestException, error:
+            handler.respond(502, [('content-type', 'application/xml')],
+                            ERROR % error)
+            return
+        try:
+            if r.status_code not in (200, 206):
+                handler.respond(r.status_code,
+                                [('content-type', 'application/xml')],
+                                r.content.replace(self.upstream, local))
+                return
+            handler.send_response(r.status_code)
+            for name in RESPONSE_HEADERS + ('content-length',):
+                if name in r.headers:
+                    handler.send_header(name, r.headers[name])
+            if 'content-length' not in r.headers:
+                handler.send_header('connection', 'close')
+                handler.close_connection = True
+            handler.end_headers()
+            for chunk in r.iter_content(1024 * 1024):
+                handler.wfile.write(chunk)
+        finally:
+            r.close()
+
+    def invalidate(self, method, path):
+        """Discard the cached responses that the write may have made stale:
+        those for the kind of entity written, or all for a POST. The reads
+        in progress for these are not cached, and later identical reads
+        make new requests instead of waiting for them."""
+        if method == 'POST':
+            prefix = None
+        else:
+            prefix = self._get_prefix(path)
+        with self.lock:
+            self.writes += 1
+            self._generations[prefix] = self._generations.get(prefix, 0) + 1
+            for mapping in (self.cache, self._flights):
+                for key in mapping.keys():
+                    if prefix is None or key[1].startswith(prefix):
+                        del mapping[key]
+
+
+class _Flight(object):
+    "A read in progress, which other threads may wait for."
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.generation = None          # See Proxy._get_generation.
+
+    def wait(self):
+        self.done.wait()
+        if self.response is None:
+            return (502, [('content-type', 'application/xml')],
+                    ERROR % 'request failed')
+        return self.response
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'       # Keep the client connections open.
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, headers, content):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('content-length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.server.proxy.handle(self, 'GET')
+
+    def do_PUT(self):
+        self.server.proxy.handle(self, 'PUT')
+
+    def do_POST(self):
+        self.server.proxy.handle(self, 'POST')
+
+    def do_DELETE(self):
+        self.server.proxy.handle(self, 'DELETE')
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Caching proxy for the GenoLogics LIMS server.')
+    parser.add_argument('--baseuri', required=True,
+                        help='base URI of the server')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--host', default='localhost',
+                        help='address to listen on')
+    parser.add_argument('--ttl', type=float, default=60.0,
+                        help='seconds to keep responses')
+    parser.add_argument('--max-entries', type=int, default=10000)
+    parser.add_argument('--connections', type=int, default=16,
+                        help='connections to keep open to the server')
+    parser.add_argument('--timeout', type=float, default=None)
+    options = parser.parse_args(args)
+    proxy = Proxy(options.baseuri, port=options.port, host=options.host,
+                  ttl=options.ttl, max_entries=options.max_entries,
+                  connections=options.connections, timeout=options.timeout)
+    sys.stderr.write("Proxy for %s at %s\n" % (proxy.upstream, proxy.baseuri))
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Query expressions over entity instances. The parts of an expression that
+the list calls of the REST API can express are sent to the server, and the
+rest is evaluated locally on the instances, loaded in batches as the
+result is iterated over.
+
+    from genologics.query import Field, Udf
+    query = lims.query(Sample, (Udf('Conc') >= 5) &
+                               Field('name').matches(r'^P1_'),
+                       projectlimsid='KRA61')
+    for sample in query: ...
+    print query.stats()
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import re
+import operator
+
+
+class Field(object):
+    """An attribute of an instance, to be used in an expression.
+    Comparisons of attributes are always evaluated locally."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+    def get_value(self, instance):
+        return getattr(instance, self.name)
+
+    def get_param(self):
+        "Return the list query parameter for this field, or None if none."
+        return None
+
+    def __eq__(self, value):
+        return Compare(self, '==', value)
+
+    def __ne__(self, value):
+        return Compare(self, '!=', value)
+
+    def __lt__(self, value):
+        return Compare(self, '<', value)
+
+    def __le__(self, value):
+        return Compare(self, '<=', value)
+
+    def __gt__(self, value):
+        return Compare(self, '>', value)
+
+    def __ge__(self, value):
+        return Compare(self, '>=', value)
+
+    def isin(self, values):
+        return In(self, values)
+
+    def matches(self, pattern):
+        "Regular expression search in the value as a string."
+        return Match(self, pattern)
+
+
+class Udf(Field):
+    """A UDF value of an instance, to be used in an expression.
+    Equality, and ranges given by numbers, are evaluated by the server."""
+
+    def get_value(self, instance):
+        try:
+            return instance.udf[self.name]
+        except KeyError:
+            return None
+
+    def get_param(self):
+        return "udf.%s" % self.name
+
+
+class Expression(object):
+    "Abstract base class for expressions; combine with &, | and ~."
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def evaluate(self, instance):
+        "Does the instance match the expression?"
+        raise NotImplementedError
+
+    def pushdown(self):
+        """Return a tuple (params, residual): the list query parameters that
+        the server can evaluate, and the expression remaining to evaluate
+        locally, or None if there is none."""
+        return dict(), self
+
+
+class Compare(Expression):
+    "Comparison of a field with a value."
+
+    OPERATORS = {'==': operator.eq, '!=': operator.ne,
+                 '<': operator.lt, '<=': operator.le,
+                 '>': operator.gt, '>=': operator.ge}
+
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return "(%r %s %r)" % (self.field, self.op, self.value)
+
+    def evaluate(self, instance):
+        value = self.field.get_value(instance)
+        if value is None: return False
+        if isinstance(self.value, (int, float)) and \
+           isinstance(value, basestring):
+            try:
+                value = float(value)
+            except ValueError:
+                return False
+        return self.OPERATORS[self.op](value, self.value)
+
+    def pushdown(self):
+        param = self.field.get_param()
+        if param is None:
+            return dict(), self
+        if self.op == '==':
+            return {param: self.value}, None
+        # The server compares ranges numerically, and inclusively.
+        if not isinstance(self.value, (int, float)) or \
+           isinstance(self.value, bool):
+            return dict(), self
+        if self.op == '>=':
+            return {"%s.min" % param: self.value}, None
+        elif self.op == '>':
+            return {"%s.min" % param: self.value}, self
+        elif self.op == '<=':
+            return {"%s.max" % param: self.value}, None
+        elif self.op == '<':
+            return {"%s.max" % param: self.value}, self
+        return dict(), self
+
+
+class In(Expression):
+    "Membership of the value of a field in a list of values."
+
+    def __init__(self, field, values):
+        self.field = field
+        self.values = list(values)
+
+    def __repr__(self):
+        return "(%r in %r)" % (self.field, self.values)
+
+    def evaluate(self, instance):
+        return self.field.get_value(instance) in self.values
+
+    def pushdown(self):
+        param = self.field.get_param()
+        # The server would ignore an empty list, and match all instances.
+        if param is None or not self.values:
+            return dict(), self
+        return {param: self.values}, None
+
+
+class Match(Expression):
+    "Regular expression search in the value of a field."
+
+    def __init__(self, field, pattern):
+        self.field = field
+        self.pattern = re.compile(pattern)
+
+    def __repr__(self):
+        return "(%r matches %r)" % (self.field, self.pattern.pattern)
+
+    def evaluate(self, instance):
+        value = self.field.get_value(instance)
+        if value is None: return False
+        return self.pattern.search(unicode(value)) is not None
+
+
+class And(Expression):
+    "Conjunction of expressions."
+
+    def __init__(self, *operands):
+        self.operands = operands
+
+    def __repr__(self):
+        return "(%s)" % ' & '.join([repr(o) for o in self.operands])
+
+    def evaluate(self, instance):
+        for operand in self.operands:
+            if not operand.evaluate(instance): return False
+        return True
+
+    def pushdown(self):
+        params = dict()
+        residuals = []
+        for operand in self.operands:
+            pushed, residual = operand.pushdown()
+            if set(pushed).intersection(params):
+                # A parameter can be given only once.
+                residuals.append(operand)
+                continue
+            params.update(pushed)
+            if residual is not None:
+                residuals.append(residual)
+        if not residuals:
+            return params, None
+        elif len(residuals) == 1:
+            return params, residuals[0]
+        return params, And(*residuals)
+
+
+class Or(Expression):
+    """Disjunction of expressions. Evaluated by the server only if all
+    operands are equalities for the same UDF."""
+
+    def __init__(self, *operands):
+        self.operands = operands
+
+    def __repr__(self):
+        return "(%s)" % ' | '.join([repr(o) for o in self.operands])
+
+    def evaluate(self, instance):
+        for operand in self.operands:
+            if operand.evaluate(instance): return True
+        return False
+
+    def pushdown(self):
+        param = None
+        values = []
+        for operand in self.operands:
+            if isinstance(operand, Compare) and operand.op == '==':
+                operand_values = [operand.value]
+            elif isinstance(operand, In):
+                operand_values = operand.values
+            else:
+                return dict(), self
+            operand_param = operand.field.get_param()
+            if operand_param is None: return dict(), self
+            if param is not None and param != operand_param:
+                return dict(), self
+            param = operand_param
+            values.extend(operand_values)
+        if not values:                  # As for In.
+            return dict(), self
+        return {param: values}, None
+
+
+class Not(Expression):
+    "Negation of an expression; always evaluated locally."
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def __repr__(self):
+        return "~%r" % (self.operand,)
+
+    def evaluate(self, instance):
+        return not self.operand.evaluate(instance)
+
+
+class Query(object):
+    """The instances of an entity class matching an expression, obtained
+    when iterated over. The list query is made with the parameters of the
+    expression that the server can evaluate. The instances it returns are
+    loaded in batches of 'chunk_size', and the remaining expression is
+    evaluated on each batch in turn, if there is any remaining expression.
+    The counts are updated during iteration.
+    """
+
+    def __init__(self, lims, klass, where, params=dict(), parallel=False,
+                 chunk_size=None):
+        self.lims = lims
+        self.klass = klass
+        self.where = where
+        self.params = dict(params)
+        self.parallel = parallel
+        self.chunk_size = chunk_size or lims.BATCH_SIZE
+        pushed, self.residual = where.pushdown()
+        if set(pushed).intersection(self.params):
+            # Conflicts with a given parameter; evaluate it all locally.
+            pushed, self.residual = dict(), where
+        self.pushed = pushed
+        self.params.update(pushed)
+        self.fetched = 0                # Instances returned by the server.
+        self.rejected = 0               # Instances rejected locally.
+        self.matched = 0
+
+    def __iter__(self):
+        self.fetched = self.rejected = self.matched = 0
+        chunk = []
+        for id in self.lims._get_references(self.klass, self.params,
+                                            parallel=self.parallel):
+            self.fetched += 1
+            chunk.append(self.lims._get_instance(self.klass, id))
+            if len(chunk) >= self.chunk_size:
+                for instance in self._filter(chunk):
+                    yield instance
+                chunk = []
+        for instance in self._filter(chunk):
+            yield instance
+
+    def _filter(self, instances):
+        if self.residual is not None and instances:
+            self.lims.load_batch(instances)
+        for instance in instances:
+            if self.residual is None or self.residual.evaluate(instance):
+                self.matched += 1
+                yield instance
+            else:
+                self.rejected += 1
+
+    def stats(self):
+        """Return a dictionary describing the evaluation so far: the
+        parameters and residual expression, and the number of instances
+        fetched from the server, rejected locally and matched."""
+        return dict(pushed=self.pushed, residual=self.residual,
+                    fetched=self.fetched, rejected=self.rejected,
+                    matched=self.matched)
@@ -0,0 +1,8 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Unit tests; no server is needed. Run from the directory containing
+the package: python -m unittest discover genologics.tests
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
@@ -0,0 +1,114 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Unit tests of the entities.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import unittest
+import multiprocessing
+
+from genologics.lims import Lims
+from genologics.entities import ElementTree, Project
+
+SAMPLE = """<smp:sample xmlns:smp="http://genologics.com/ri/sample" \
+xmlns:udf="http://genologics.com/ri/userdefined" limsid="S1" \
+uri="http://localhost/api/v1/samples/S1"><name>Sample 1</name>\
+<project limsid="P1" uri="http://localhost/api/v1/projects/P1"/>\
+<udf:field type="Numeric" name="Conc">5</udf:field>\
+<udf:field type="String" name="Color">Blue</udf:field></smp:sample>"""
+
+
+class CannedLims(Lims):
+    "Serves a single sample, and records the requests."
+
+    def __init__(self, *args, **kwargs):
+        super(CannedLims, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def get(self, uri, params=dict(), priority=None):
+        self.requests.append(('GET', uri))
+        return ElementTree.fromstring(SAMPLE)
+
+    def post(self, uri, data, params=dict(), priority=None, parse=True):
+        self.requests.append(('POST', uri))
+        content = '<smp:details xmlns:smp="http://genologics.com/ri/sample">' \
+                  '%s</smp:details>' % SAMPLE
+        if parse:
+            return ElementTree.fromstring(content)
+        return content
+
+    def put(self, uri, data, params=dict(), priority=None):
+        self.requests.append(('PUT', uri))
+        self.data = data
+        return ElementTree.fromstring(data)
+
+
+class TestProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.lims = CannedLims('http://localhost/', 'user', 'password')
+        self.sample = self.lims.get_sample('S1')
+        self.lims.load_batch([self.sample], fields=['name', 'udf:Conc'])
+        self.lims.requests = []
+
+    def test_projected_values(self):
+        self.assertTrue(self.sample.root is None)
+        self.assertEqual(self.sample.name, 'Sample 1')
+        self.assertEqual(self.sample.udf['Conc'], 5)
+        self.assertEqual(self.lims.requests, [])
+
+    def test_modified_udf_is_saved(self):
+        self.sample.udf['Conc'] = 7
+        self.assertEqual(self.sample.udf['Conc'], 7)
+        self.assertEqual(self.sample.udf['Color'], 'Blue')
+        self.sample.put()
+        self.assertEqual([r[0] for r in self.lims.requests], ['GET', 'PUT'])
+        root = ElementTree.fromstring(self.lims.data)
+        values = dict([(n.attrib['name'], n.text) for n in root.iter()
+                       if 'name' in n.attrib])
+        self.assertEqual(values, dict(Conc='7', Color='Blue'))
+
+    def test_put_unmodified(self):
+        self.sample.put()
+        self.assertEqual([r[0] for r in self.lims.requests], ['GET', 'PUT'])
+
+    def test_load_batch_keeps_projection(self):
+        self.lims.load_batch([self.sample], fields=['name'])
+        self.assertEqual(self.lims.requests, [])
+        self.lims.load_batch([self.sample], fields=['name', 'udf:Color'])
+        self.assertEqual([r[0] for r in self.lims.requests], ['POST'])
+        self.assertEqual(self.sample.udf['Color'], 'Blue')
+
+
+class TestProjectionPool(TestProjection):
+    "The same, with the batch responses parsed in a process pool."
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = multiprocessing.Pool(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        cls.pool.join()
+
+    def setUp(self):
+        self.lims = CannedLims('http://localhost/', 'user', 'password',
+                               parse_pool=self.pool)
+        self.sample = self.lims.get_sample('S1')
+        self.lims.load_batch([self.sample],
+                             fields=['name', 'project', 'udf:Conc'])
+        self.lims.requests = []
+
+    def test_referenced_instance(self):
+        project = self.sample.project
+        self.assertTrue(isinstance(project, Project))
+        self.assertTrue(project is self.lims.get_project('P1'))
+        self.assertTrue(project.lims is self.lims)
+        self.assertEqual(self.lims.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Unit tests of the LIMS interface.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import time
+import threading
+import unittest
+
+import requests
+
+from genologics.lims import Lims, DeadlineExceeded
+from genologics.entities import Sample, ElementTree
+
+
+class RecordingLims(Lims):
+    "Records the GET requests, and returns an empty list for each."
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingLims, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def get(self, uri, params=dict(), priority=None):
+        self.requests.append((uri, params))
+        return ElementTree.fromstring('<smp:samples '
+            'xmlns:smp="http://genologics.com/ri/sample"/>')
+
+
+class TestSplitParams(unittest.TestCase):
+
+    def setUp(self):
+        self.lims = RecordingLims('http://localhost/', 'user', 'password')
+        self.names = [u'Prov \xe5\xe4\xf6 %i' % i for i in xrange(300)]
+
+    def get_url(self, uri, params):
+        "Return the URL as sent by 'requests'."
+        return requests.Request('GET', uri, params=params).prepare().url
+
+    def test_non_ascii_values(self):
+        uri = self.lims.uri(Sample._URI)
+        queries = self.lims._split_params(uri, dict(name=self.names))
+        self.assertTrue(len(queries) > 1)
+        found = []
+        for query in queries:
+            url = self.get_url(uri, query)
+            self.assertEqual(self.lims._get_url_length(uri, query), len(url))
+            self.assertTrue(len(url) <= self.lims.MAX_URL_LENGTH)
+            found.extend(query['name'])
+        self.assertEqual(found, self.names)
+
+    def test_get_samples_non_ascii_names(self):
+        self.assertEqual(self.lims.get_samples(name=self.names,
+                                               projectlimsid='KRA61'), [])
+        self.assertTrue(len(self.lims.requests) > 1)
+        found = []
+        for uri, params in self.lims.requests:
+            self.assertEqual(params['projectlimsid'], 'KRA61')
+            url = self.get_url(uri, params)
+            self.assertTrue(len(url) <= self.lims.MAX_URL_LENGTH)
+            found.extend(params['name'])
+        self.assertEqual(sorted(found), sorted(self.names))
+
+
+class SlowLims(Lims):
+    "Returns a sample after a delay, checking the deadline, if any."
+
+    DELAY = 0.2
+
+    def get(self, uri, params=dict(), priority=None):
+        time.sleep(self.DELAY)
+        self._get_timeout()             # Raises DeadlineExceeded if expired.
+        return ElementTree.fromstring('<smp:sample '
+            'xmlns:smp="http://genologics.com/ri/sample" limsid="S1">'
+            '<name>Sample 1</name></smp:sample>')
+
+
+class TestLoadDeadline(unittest.TestCase):
+
+    def test_deadline_not_shared(self):
+        "A deadline of the caller making the request is not the others'."
+        lims = SlowLims('http://localhost/', 'user', 'password')
+        sample = lims.get_sample('S1')
+        results = dict()
+        def load(name, deadline):
+            try:
+                if deadline is None:
+                    sample.get()
+                else:
+                    with lims.deadline(deadline):
+                        sample.get()
+                results[name] = sample.name
+            except Exception, error:
+                results[name] = error
+        first = threading.Thread(target=load, args=('deadline', 0.1))
+        first.start()
+        time.sleep(0.05)                # The second waits for the first.
+        second = threading.Thread(target=load, args=('none', None))
+        second.start()
+        first.join()
+        second.join()
+        self.assertTrue(isinstance(results['deadline'], DeadlineExceeded))
+        self.assertEqual(results['none'], 'Sample 1')
+
+    def test_deadline_waiting_for_lane(self):
+        "The deadline applies while waiting for a place in a lane."
+        lims = Lims('http://localhost/', 'user', 'password',
+                    lanes=dict(interactive=1))
+        held = threading.Event()
+        release = threading.Event()
+        def hold():
+            with lims._enter_lane():
+                held.set()
+                release.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        start = time.time()
+        try:
+            with lims.deadline(0.2):
+                with lims._enter_lane():
+                    pass
+            self.fail('DeadlineExceeded not raised')
+        except DeadlineExceeded:
+            self.assertTrue(time.time() - start < 1.0)
+        finally:
+            release.set()
+            thread.join()
+
+
+class PagedLims(Lims):
+    """Returns the list of samples in pages, expiring the deadline at the
+    request for the page at 'expire_at', the first time only."""
+
+    TOTAL = 5000
+    PAGE_SIZE = 500
+
+    def __init__(self, *args, **kwargs):
+        super(PagedLims, self).__init__(*args, **kwargs)
+        self.expire_at = None
+
+    def get(self, uri, params=dict(), priority=None):
+        start = self._get_start_index(uri)
+        if start == self.expire_at:
+            self.expire_at = None
+            raise DeadlineExceeded('deadline exceeded')
+        parts = ['<smp:samples xmlns:smp="http://genologics.com/ri/sample">']
+        for i in xrange(start, min(start + self.PAGE_SIZE, self.TOTAL)):
+            parts.append('<sample limsid="S%i" uri="%s/S%i"/>' %
+                         (i, self.uri('samples'), i))
+        if start + self.PAGE_SIZE < self.TOTAL:
+            parts.append('<next-page uri="%s"/>' %
+                         self._get_page_uri(self.uri('samples'),
+                                            start + self.PAGE_SIZE))
+        parts.append('</smp:samples>')
+        return ElementTree.fromstring(''.join(parts))
+
+
+class TestResume(unittest.TestCase):
+
+    def check_resume(self, parallel):
+        lims = PagedLims('http://localhost/', 'user', 'password', threads=4)
+        lims.expire_at = 1500
+        with lims.deadline(60, partial=True):
+            first = lims.get_samples(parallel=parallel)
+            self.assertTrue(first.resume is not None)
+            rest = lims.resume(first.resume)
+        ids = [s.id for s in first] + [s.id for s in rest]
+        self.assertEqual(ids, ["S%i" % i for i in xrange(PagedLims.TOTAL)])
+
+    def test_resume_sequential(self):
+        self.check_resume(False)
+
+    def test_resume_parallel(self):
+        self.check_resume(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
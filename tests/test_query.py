@@ -0,0 +1,37 @@
+"""Python interface to GenoLogics LIMS via its REST API.
+
+Unit tests of the query expressions.
+
+Per Kraulis, Science for Life Laboratory, Stockholm, Sweden.
+Copyright (C) 2012 Per Kraulis
+"""
+
+import unittest
+
+from genologics.query import Udf
+
+
+class TestPushdown(unittest.TestCase):
+
+    def test_isin(self):
+        expression = Udf('Flowcell').isin(['FC1', 'FC2'])
+        self.assertEqual(expression.pushdown(),
+                         ({'udf.Flowcell': ['FC1', 'FC2']}, None))
+
+    def test_isin_empty(self):
+        "An empty list is not given to the server, which would ignore it."
+        expression = Udf('Flowcell').isin([])
+        self.assertEqual(expression.pushdown(), (dict(), expression))
+
+    def test_or_empty(self):
+        expression = Udf('Flowcell').isin([]) | Udf('Flowcell').isin([])
+        self.assertEqual(expression.pushdown(), (dict(), expression))
+
+    def test_and_empty(self):
+        empty = Udf('Flowcell').isin([])
+        expression = (Udf('Conc') == 5) & empty
+        self.assertEqual(expression.pushdown(), ({'udf.Conc': 5}, empty))
+
+
+if __name__ == '__main__':
+    unittest.main()